@@ -1,16 +1,37 @@
 import os
-import boto3
+import asyncio
+import base64
+import hashlib
+import json
+import math
+import time
 import logging
+import mimetypes
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from botocore.exceptions import ClientError
 from boto3.s3.transfer import TransferConfig
-from fastapi import FastAPI, Depends, File, UploadFile, HTTPException
-from fastapi.responses import StreamingResponse
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Depends, File, UploadFile, HTTPException, Request, Query
+from fastapi.responses import StreamingResponse, Response
 from sqlalchemy.orm import Session
 from uuid import uuid4, UUID
 from urllib.parse import urlparse
-from typing import Optional
+from typing import List, Optional
+from datetime import datetime, timedelta, timezone
 from . import models, schemas, crud
-from .database import get_db
+from .database import get_db, SessionLocal
+from .clients import get_s3_client
+from .cache import TTLCache
+from .notify import status_notifier
+from .renditions import parse_rendition_set
+from .queues import get_job_queue, s3_event_body
+from .archives import ArchiveReader, is_archive
+from .download_cache import DiskCache
+from .metrics import DOWNLOAD_CACHE_REQUESTS, HTTP_REQUEST_SECONDS, observe_transfer, render_metrics
+from .cost_model import CostModel, BacklogEstimate, estimate_backlog
+from .profiles import fleet_slots
 
 
 ### To view s3 Multipart upload
@@ -19,14 +40,141 @@ from .database import get_db
 # logging.getLogger('boto3').setLevel(logging.DEBUG)
 # logging.getLogger('botocore').setLevel(logging.DEBUG)
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    status_notifier.start(asyncio.get_running_loop())
+    yield
+    status_notifier.stop()
+
+app = FastAPI(lifespan=lifespan)
+
+@app.middleware("http")
+async def record_request_duration(request: Request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    # label by route template, not the raw path, to keep one series per endpoint
+    route = request.scope.get("route")
+    HTTP_REQUEST_SECONDS.labels(request.method, route.path if route else "unmatched", response.status_code).observe(time.perf_counter() - start)
+    return response
 
 @app.get("/")
 def root():
     return "Hello HTX!!"
 
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
+
 #### Helper functions #####
 
+TERMINAL_STATUSES = {models.ProcessingStatus.COMPLETED.value, models.ProcessingStatus.FAILED.value}
+
+# Status of a file as a StatusResponse dict, served from the status cache when possible (invalidated by NOTIFY)
+# Uses its own short session so long-lived waits never hold a DB connection
+def _read_status(file_id: UUID) -> Optional[dict]:
+    status = status_notifier.status_cache.get(str(file_id))
+    if status is None:
+        generation = status_notifier.invalidations
+        db = SessionLocal()
+        try:
+            db_file = crud.get_file(db, file_id)
+            if db_file is None:
+                return None
+            status = schemas.StatusResponse.model_validate(db_file).model_dump(mode="json")
+        finally:
+            db.close()
+        status_notifier.cache_status(file_id, status, generation)
+    return _with_prediction(file_id, status)
+
+#### Predicted completion, from the historical cost model (cost_model.py) #####
+# The model and the backlog estimate are shared by every request for a few seconds,
+# predictions per file until its status or progress changes (or the backlog cache expires)
+
+_cost_model_cache = TTLCache(maxsize=1, ttl=float(os.getenv("COST_MODEL_CACHE_TTL", "60")))
+_backlog_cache = TTLCache(maxsize=1, ttl=float(os.getenv("BACKLOG_CACHE_TTL", "15")))
+_prediction_cache = TTLCache(maxsize=int(os.getenv("STATUS_CACHE_SIZE", "10000")), ttl=_backlog_cache.ttl)
+
+def _utcnow() -> datetime:
+    # timestamps are stored naive, in the database server's time zone (UTC)
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def _cost_model(db: Session) -> CostModel:
+    model = _cost_model_cache.get("model")
+    if model is None:
+        model = CostModel(crud.get_throughput(db))
+        _cost_model_cache.set("model", model)
+    return model
+
+def _backlog(db: Session) -> BacklogEstimate:
+    backlog = _backlog_cache.get("backlog")
+    if backlog is None:
+        backlog = estimate_backlog(_cost_model(db), crud.get_pending_work(db), crud.get_processing_jobs(db), fleet_slots())
+        _backlog_cache.set("backlog", backlog)
+    return backlog
+
+def _predict_completion(db: Session, file_id: UUID, status: dict, ahead: int = None) -> Optional[datetime]:
+    model = _cost_model(db)
+    original_codec = status["original_codec"] and models.Codec(status["original_codec"])
+    target_codec = status["target_codec"] and models.Codec(status["target_codec"])
+    predicted = model.predict(original_codec, target_codec, status["duration"])
+    now = _utcnow()
+    if status["processing_status"] == models.ProcessingStatus.PROCESSING.value:
+        started = datetime.fromisoformat(status["processing_started_at"]) if status["processing_started_at"] else now
+        progress_at = status["progress_updated_at"] and datetime.fromisoformat(status["progress_updated_at"])
+        if status["eta_seconds"] is not None and progress_at and progress_at >= started:
+            return max(progress_at + timedelta(seconds=status["eta_seconds"]), now)
+        return max(started + timedelta(seconds=predicted), now) if predicted is not None else None
+    if predicted is None:
+        return None
+    # jobs ahead start as slots free up. The scheduler runs short jobs first, so this is upload order approximately
+    backlog = _backlog(db)
+    if ahead is None:
+        ahead = crud.count_pending_before(db, datetime.fromisoformat(status["created_at"]), file_id)
+    wait = (backlog.processing_remaining_seconds + ahead * (backlog.mean_pending_job_seconds or predicted)) / backlog.fleet_slots
+    return now + timedelta(seconds=wait + predicted)
+
+def _prediction_key(status: dict) -> tuple:
+    return (str(status["file_id"]), status["processing_status"], status["progress_updated_at"])
+
+def _with_prediction(file_id: UUID, status: dict) -> dict:
+    if status["processing_status"] in TERMINAL_STATUSES:
+        return status
+    key = _prediction_key(status)
+    predicted = _prediction_cache.get(key)
+    if predicted is None:
+        db = SessionLocal()
+        try:
+            predicted = _predict_completion(db, file_id, status)
+        finally:
+            db.close()
+        predicted = predicted.isoformat() if predicted else ""
+        _prediction_cache.set(key, predicted)
+    return {**status, "predicted_completion_at": predicted or None}
+
+# _with_prediction for many statuses (StatusResponse dicts): one session, and one queue position query
+# for all the pending files whose prediction is not cached
+def _with_predictions(statuses: list) -> list:
+    uncached = [
+        status for status in statuses
+        if status["processing_status"] not in TERMINAL_STATUSES and _prediction_cache.get(_prediction_key(status)) is None
+    ]
+    if uncached:
+        db = SessionLocal()
+        try:
+            pending = [
+                (datetime.fromisoformat(status["created_at"]), UUID(str(status["file_id"])))
+                for status in uncached if status["processing_status"] == models.ProcessingStatus.PENDING.value
+            ]
+            ahead = crud.count_pending_before_each(db, pending)
+            for status in uncached:
+                file_id = UUID(str(status["file_id"]))
+                predicted = _predict_completion(db, file_id, status, ahead.get(file_id, 0))
+                _prediction_cache.set(_prediction_key(status), predicted.isoformat() if predicted else "")
+        finally:
+            db.close()
+    return [_with_prediction(status["file_id"], status) for status in statuses]
+
 # _get_file
 def _get_file(db: Session, file_id: UUID) -> models.Files:
     db_file = crud.get_file(db, file_id)
@@ -34,47 +182,267 @@ def _get_file(db: Session, file_id: UUID) -> models.Files:
         raise HTTPException(status_code=404, detail=f"File with ID {file_id} not found.")
     return db_file
 
-# download from s3 presigned url
-def _get_presigned_s3_url(s3_url: str, download_filename: Optional[str]) -> StreamingResponse:
-    s3_endpoint_url = os.getenv("S3_ENDPOINT_URL") or None
-    s3_client = boto3.client("s3", endpoint_url=s3_endpoint_url)
-
+# s3://bucket/key -> (bucket, key)
+def _parse_s3_url(s3_url: str):
     s3_path = urlparse(s3_url, allow_fragments=False)
     bucket_name = s3_path.netloc  # The bucket name
     s3_key = s3_path.path.lstrip('/')
 
     if not bucket_name or not s3_key:
         raise ValueError("Invalid S3 URL provided.")
-    
+    return bucket_name, s3_key
+
+# original_filename-uuid.ext
+def _raw_s3_key(file_name: str, file_id: UUID) -> str:
+    name_stem, file_extension = os.path.splitext(file_name)
+    return f"{name_stem}-{file_id}{file_extension}"
+
+# Validated rendition names of an upload request, eg "720p_h264,480p_h264"
+def _parse_renditions(renditions) -> list:
+    if not renditions:
+        return []
+    try:
+        return parse_rendition_set(renditions)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+def _rendition_download_name(file_name: str, rendition_name: str) -> str:
+    name_stem, _ = os.path.splitext(file_name)
+    return f"{name_stem}_{rendition_name}.mp4"
+
+def _preview_download_name(file_name: str, kind: str) -> str:
+    name_stem, _ = os.path.splitext(file_name)
+    return f"{name_stem}_{kind}.jpg"
+
+# File-like wrapper that hashes the bytes read through it, so uploads are hashed while streaming to S3
+class _HashingReader:
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self.hash = hashlib.sha256()
+        self.bytes_read = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._fileobj.read(size)
+        self.hash.update(data)
+        self.bytes_read += len(data)
+        return data
+
+# With the postgres queue backend the api enqueues the job itself, in the caller's transaction so the job commits
+# together with the PENDING transition. With SQS the raw bucket's S3 event notification does
+def _enqueue(db: Session, raw_file_urls: list):
+    queue = get_job_queue()
+    if queue.enqueues_on_upload:
+        queue.add_jobs(db, [s3_event_body(*_parse_s3_url(raw_file_url)) for raw_file_url in raw_file_urls])
+
+# Content-hash cache: reuse the processed output of an identical completed upload with the same requested
+# codec and container, else queue for transcoding. reuse=False for uploads requesting renditions, which are encoded per file
+def _finish_upload(db: Session, file_id: UUID, content_hash: str, reuse: bool = True,
+                   target_codec: models.Codec = None, faststart: bool = False, raw_file_url: str = None) -> models.ProcessingStatus:
+    source = reuse and crud.get_completed_file_by_hash(db, content_hash, file_id, target_codec, faststart)
+    if source and crud.reuse_processed_output(db, file_id, source):
+        print(f"Cache hit for {file_id}: reused processed output of {source.file_id}")
+        return models.ProcessingStatus.COMPLETED
+    # with SQS the S3 event can reach a worker first, a file it claimed is left alone
+    pending = (models.Files.processing_status == models.ProcessingStatus.PENDING,)
+    if not crud.transition_file(db, file_id, models.TransactionType.PENDING, "File upload complete, awaiting transcoding",
+                                where=pending, commit=False, content_hash=content_hash):
+        db.rollback()
+        return crud.get_file(db, file_id).processing_status
+    _enqueue(db, [raw_file_url])
+    db.commit()
+    return models.ProcessingStatus.PENDING
+
+# download from s3 presigned url
+# Presigned URLs are valid for 1h, cached URLs are served for at most PRESIGNED_URL_CACHE_TTL (default 50min)
+# so a URL handed out from the cache always has some validity left
+PRESIGNED_URL_EXPIRY = 3600
+_presigned_url_cache = TTLCache(
+    maxsize=int(os.getenv("PRESIGNED_URL_CACHE_SIZE", "10000")),
+    ttl=min(int(os.getenv("PRESIGNED_URL_CACHE_TTL", "3000")), PRESIGNED_URL_EXPIRY - 60),
+)
+
+def _get_presigned_s3_url(s3_url: str, download_filename: Optional[str]) -> StreamingResponse:
+    bucket_name, s3_key = _parse_s3_url(s3_url)
+
+    cache_key = (bucket_name, s3_key, download_filename)
+    url = _presigned_url_cache.get(cache_key)
+    if url is not None:
+        return url
+
     params = {'Bucket': bucket_name, 'Key': s3_key}
     if download_filename:
         params['ResponseContentDisposition'] = f'attachment; filename="{download_filename}"'
 
     try:
-        url = s3_client.generate_presigned_url(
+        url = get_s3_client().generate_presigned_url(
             'get_object',
             Params=params,
-            ExpiresIn=3600  # 1h
+            ExpiresIn=PRESIGNED_URL_EXPIRY  # 1h
         )
+        _presigned_url_cache.set(cache_key, url)
         return url
     except ClientError as e:
         raise HTTPException(status_code=500, detail=f"Could not generate presigned URL: {e}")
 
+# Download proxy: with DOWNLOAD_PROXY=true (or ?proxy=true) the download endpoints stream the object through the API
+# instead of returning a presigned URL, with single-range HTTP Range requests for seeking. Objects up to
+# DOWNLOAD_CACHE_MAX_OBJECT_MB are copied to a local LRU disk cache on their first download (in the background,
+# the first request streams from S3) and served from disk afterwards. version is the completion time of the job that
+# wrote the object (_output_version), so a reprocessed output is fetched again from S3, and None for raw objects, which are never rewritten
+PROXY_CHUNK_SIZE = 1024 * 1024
+_download_caches = {}
+_cache_fill_executor = ThreadPoolExecutor(max_workers=2)
+
+def _proxy_enabled(proxy: Optional[bool]) -> bool:
+    if proxy is not None:
+        return proxy
+    return os.getenv("DOWNLOAD_PROXY", "false").lower() == "true"
+
+def _download_cache() -> Optional[DiskCache]:
+    # one per process, the cache index is in memory (DOWNLOAD_CACHE_MAX_MB=0 disables)
+    max_mb = int(os.getenv("DOWNLOAD_CACHE_MAX_MB", "2048"))
+    if max_mb <= 0:
+        return None
+    key = os.getpid()
+    cache = _download_caches.get(key)
+    if cache is None:
+        directory = os.path.join(os.getenv("DOWNLOAD_CACHE_DIR", "/tmp/transcoder-download-cache"), str(key))
+        cache = DiskCache(directory, max_mb * MB, int(os.getenv("DOWNLOAD_CACHE_MAX_OBJECT_MB", "512")) * MB)
+        _download_caches[key] = cache
+    return cache
+
+# (first, last) of a single "bytes=first-last" Range header, as strings, either may be empty: "bytes=500-" is open
+# ended, "bytes=-500" the last 500 bytes. None without a header, for multiple ranges (not supported) or another unit
+def _single_byte_range(range_header: Optional[str]) -> Optional[tuple]:
+    if not range_header:
+        return None
+    unit, _, spec = range_header.partition("=")
+    first, _, last = spec.strip().partition("-")
+    if unit.strip().lower() != "bytes" or "," in spec or not (first or last):
+        return None
+    if not all(value.isdigit() for value in (first, last) if value):
+        return None
+    return first, last
+
+# Range header -> (start, end) inclusive within an object of size bytes, None to send the whole object.
+# Unsatisfiable ranges are a 416
+def _parse_range(range_header: Optional[str], size: int) -> Optional[tuple]:
+    byte_range = _single_byte_range(range_header)
+    if byte_range is None:
+        return None
+    first, last = byte_range
+    if first:
+        start, end = int(first), int(last) if last else size - 1
+    else:
+        start, end = max(size - int(last), 0), size - 1
+    if start >= size or end < start:
+        raise HTTPException(status_code=416, detail="Range not satisfiable", headers={"Content-Range": f"bytes */{size}"})
+    return start, min(end, size - 1)
+
+def _iter_file(fileobj, start: int, length: int):
+    try:
+        fileobj.seek(start)
+        while length > 0:
+            data = fileobj.read(min(PROXY_CHUNK_SIZE, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        fileobj.close()
+
+def _iter_s3_body(body):
+    try:
+        yield from body.iter_chunks(PROXY_CHUNK_SIZE)
+    finally:
+        body.close()
+
+def _fill_download_cache(cache: DiskCache, s3_url: str, version, size: int):
+    bucket_name, s3_key = _parse_s3_url(s3_url)
+
+    def download(path: str):
+        started = time.perf_counter()
+        get_s3_client().download_file(bucket_name, s3_key, path)
+        observe_transfer("proxy", size, time.perf_counter() - started)
+
+    cache.fill(s3_url, version, size, download)
+
+def _proxy_download(request: Request, s3_url: str, download_filename: str, version) -> StreamingResponse:
+    headers = {
+        "Accept-Ranges": "bytes",
+        "Content-Disposition": f'attachment; filename="{download_filename}"',
+    }
+    media_type = mimetypes.guess_type(download_filename)[0] or "application/octet-stream"
+    range_header = request.headers.get("range")
+    cache = _download_cache()
+
+    cached = cache and cache.open(s3_url, version)
+    if cached:
+        DOWNLOAD_CACHE_REQUESTS.labels("hit").inc()
+        fileobj, size = cached
+        try:
+            byte_range = _parse_range(range_header, size)
+        except HTTPException:
+            fileobj.close()
+            raise
+        start, end = byte_range or (0, size - 1)
+        headers["Content-Length"] = str(end - start + 1)
+        if byte_range:
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        return StreamingResponse(_iter_file(fileobj, start, end - start + 1), status_code=206 if byte_range else 200,
+                                 media_type=media_type, headers=headers)
+
+    # miss: stream from S3, passing the range on, and cache the whole object in the background
+    DOWNLOAD_CACHE_REQUESTS.labels("miss").inc()
+    bucket_name, s3_key = _parse_s3_url(s3_url)
+    params = {"Bucket": bucket_name, "Key": s3_key}
+    if _single_byte_range(range_header) is not None:
+        params["Range"] = range_header
+    try:
+        response = get_s3_client().get_object(**params)
+    except ClientError as e:
+        code = e.response.get("Error", {}).get("Code")
+        if code == "InvalidRange":
+            raise HTTPException(status_code=416, detail="Range not satisfiable")
+        if code in ("NoSuchKey", "404"):
+            raise HTTPException(status_code=404, detail=f"Object {s3_url} not found.")
+        raise HTTPException(status_code=500, detail=f"Could not read {s3_url}: {e}")
+
+    headers["Content-Length"] = str(response["ContentLength"])
+    size = response["ContentLength"]
+    if response.get("ContentRange"):
+        headers["Content-Range"] = response["ContentRange"]
+        size = int(response["ContentRange"].rpartition("/")[2])
+    if cache is not None:
+        _cache_fill_executor.submit(_fill_download_cache, cache, s3_url, version, size)
+    return StreamingResponse(_iter_s3_body(response["Body"]), status_code=206 if response.get("ContentRange") else 200,
+                             media_type=media_type, headers=headers)
+
+# Outputs shared by files with the same content are versioned by the job that wrote them, not by each File's own
+# completion, so downloads through different Files hit the same cache entry
+def _output_version(db_file: models.Files):
+    return db_file.output_completed_at or db_file.completed_at
+
+# Response of a download endpoint: a presigned URL, or the object itself in proxy mode
+def _download(request: Request, s3_url: str, download_filename: str, version, proxy: Optional[bool]):
+    if _proxy_enabled(proxy):
+        return _proxy_download(request, s3_url, download_filename, version)
+    return {"download_url": _get_presigned_s3_url(s3_url, download_filename)}
+
  #### end of helper functions #####   
 
 @app.post("/upload", response_model=schemas.UploadResponse)
-def upload_file(db: Session = Depends(get_db), file: UploadFile = File(...)):
-    s3_endpoint_url = os.getenv("S3_ENDPOINT_URL") or None
-    s3_client = boto3.client("s3", endpoint_url=s3_endpoint_url)
+def upload_file(db: Session = Depends(get_db), file: UploadFile = File(...), renditions: Optional[str] = None,
+                target_codec: Optional[models.Codec] = None, faststart: bool = False):
+    rendition_set = _parse_renditions(renditions)
+    s3_client = get_s3_client()
     file_id = uuid4()
-    name_stem, file_extension = os.path.splitext(file.filename)
-    s3_key = f"{name_stem}-{file_id}{file_extension}" # original_filename-uuid.ext
+    s3_key = _raw_s3_key(file.filename, file_id)
     bucket_name = os.getenv("S3_RAW_BUCKET")
     raw_file_url = f"s3://{bucket_name}/{s3_key}"
 
     # 1. Create new File DB record; create new Transaction record type=Upload
-    db_file = crud.create_file_record(db, file_id, file.filename, raw_file_url) #File processing status = PENDING on creation
-    crud.create_transaction(db, file_id, models.TransactionType.UPLOAD, details="Upload started by user")
+    db_file = crud.create_file_record(db, file_id, file.filename, raw_file_url, rendition_set, target_codec, faststart) #File processing status = PENDING on creation
 
     # Multipart Upload configs
     MB = 1024 * 1024
@@ -87,30 +455,432 @@ def upload_file(db: Session = Depends(get_db), file: UploadFile = File(...)):
     #2. Upload to S3
     try:
         print(f"Uploading {s3_key} file to S3 {raw_file_url}...")
-        s3_client.upload_fileobj(file.file, bucket_name, s3_key, Config=config)
+        reader = _HashingReader(file.file)
+        started = time.perf_counter()
+        s3_client.upload_fileobj(reader, bucket_name, s3_key, Config=config)
+        observe_transfer("ingest", reader.bytes_read, time.perf_counter() - started)
     except Exception as e:
-        crud.update_file_status(db, file_id, models.ProcessingStatus.FAILED)
-        crud.create_transaction(db, file_id, models.TransactionType.FAILURE, details=f"Upload failed: {str(e)}")
+        crud.fail_upload(db, file_id, f"Upload failed: {str(e)}")
         raise HTTPException(status_code=500, detail=f"S3 upload failed: {str(e)}")
 
-    # 3. Create transaction, pending in queue
-    crud.create_transaction(db, file_id, models.TransactionType.PENDING, details="File upload complete, awaiting transcoding")
+    # 3. Reuse a cached result for identical content, or create transaction, pending in queue
+    _finish_upload(db, file_id, reader.hash.hexdigest(), not rendition_set, target_codec, faststart, raw_file_url)
 
     return db_file
 
-@app.get("/upload/{file_id}/status", response_model=schemas.StatusResponse)
-def get_status(file_id: UUID, db: Session = Depends(get_db)):
+# Async streaming ingest: request body chunks are buffered into parts and uploaded to S3 as they arrive.
+# At most INGEST_MAX_IN_FLIGHT_PARTS parts are buffered or uploading at once; beyond that the body is not read,
+# which backpressures the client. S3 and DB calls run in worker threads so the event loop is never blocked.
+async def _upload_part(s3_client, bucket_name: str, s3_key: str, upload_id: str, part_number: int, data: bytes, slots: asyncio.Semaphore) -> dict:
+    try:
+        response = await asyncio.to_thread(
+            s3_client.upload_part, Bucket=bucket_name, Key=s3_key, UploadId=upload_id, PartNumber=part_number, Body=data
+        )
+        return {"PartNumber": part_number, "ETag": response["ETag"]}
+    finally:
+        slots.release()
+
+async def _stream_to_s3(request: Request, s3_client, bucket_name: str, s3_key: str):
+    part_size = max(int(os.getenv("INGEST_PART_SIZE_MB", "8")), 5) * MB # S3 minimum part size is 5MB
+    slots = asyncio.Semaphore(int(os.getenv("INGEST_MAX_IN_FLIGHT_PARTS", "4")))
+    buffer = bytearray()
+    content_hash = hashlib.sha256()
+    size = 0
+    started = time.perf_counter()
+    upload_id = None
+    tasks = []
+
+    try:
+        async for chunk in request.stream():
+            buffer += chunk
+            content_hash.update(chunk)
+            size += len(chunk)
+            while len(buffer) >= part_size:
+                if upload_id is None:
+                    upload_id = (await asyncio.to_thread(s3_client.create_multipart_upload, Bucket=bucket_name, Key=s3_key))["UploadId"]
+                data = bytes(buffer[:part_size])
+                del buffer[:part_size]
+                await slots.acquire() # backpressure: wait for a free part slot before reading more
+                tasks.append(asyncio.create_task(
+                    _upload_part(s3_client, bucket_name, s3_key, upload_id, len(tasks) + 1, data, slots)
+                ))
+
+        if upload_id is None: # smaller than one part, single PUT
+            await asyncio.to_thread(s3_client.put_object, Bucket=bucket_name, Key=s3_key, Body=bytes(buffer))
+            observe_transfer("ingest", size, time.perf_counter() - started)
+            return content_hash.hexdigest()
+        if buffer:
+            await slots.acquire()
+            tasks.append(asyncio.create_task(
+                _upload_part(s3_client, bucket_name, s3_key, upload_id, len(tasks) + 1, bytes(buffer), slots)
+            ))
+        parts = await asyncio.gather(*tasks)
+        await asyncio.to_thread(
+            s3_client.complete_multipart_upload,
+            Bucket=bucket_name, Key=s3_key, UploadId=upload_id, MultipartUpload={"Parts": list(parts)},
+        )
+        observe_transfer("ingest", size, time.perf_counter() - started)
+        return content_hash.hexdigest()
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        if upload_id is not None:
+            await asyncio.to_thread(s3_client.abort_multipart_upload, Bucket=bucket_name, Key=s3_key, UploadId=upload_id)
+        raise
+
+@app.post("/upload/stream", response_model=schemas.UploadResponse)
+async def upload_file_stream(request: Request, file_name: str, renditions: Optional[str] = None,
+                             target_codec: Optional[models.Codec] = None, faststart: bool = False, db: Session = Depends(get_db)):
+    """Uploads the raw request body (not multipart/form-data) as `file_name`."""
+    rendition_set = _parse_renditions(renditions)
+    s3_client = get_s3_client()
+    file_id = uuid4()
+    s3_key = _raw_s3_key(file_name, file_id)
+    bucket_name = os.getenv("S3_RAW_BUCKET")
+    raw_file_url = f"s3://{bucket_name}/{s3_key}"
+
+    # 1. Create new File DB record; create new Transaction record type=Upload
+    await asyncio.to_thread(crud.create_file_record, db, file_id, file_name, raw_file_url, rendition_set, target_codec, faststart)
+
+    #2. Stream to S3
+    try:
+        print(f"Streaming {s3_key} file to S3 {raw_file_url}...")
+        content_hash = await _stream_to_s3(request, s3_client, bucket_name, s3_key)
+    except Exception as e:
+        await asyncio.to_thread(crud.fail_upload, db, file_id, f"Upload failed: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"S3 upload failed: {str(e)}")
+
+    # 3. Reuse a cached result for identical content, or create transaction, pending in queue
+    status = await asyncio.to_thread(_finish_upload, db, file_id, content_hash, not rendition_set, target_codec, faststart, raw_file_url)
+
+    # built directly, reading the committed ORM object would lazy load on the event loop
+    return {"file_id": file_id, "file_name": file_name, "processing_status": status}
+
+# Uploads sources (file_id, s3_key, open callable) to S3 with INGEST_BATCH_CONCURRENCY uploads in flight.
+# Each source is opened only once a slot is free, so at most that many spooled archive members exist at a time.
+# Returns file_id -> content hash, or the exception that failed the upload
+def _upload_concurrently(s3_client, bucket_name: str, sources: list) -> dict:
+    concurrency = int(os.getenv("INGEST_BATCH_CONCURRENCY", "8"))
+    config = TransferConfig(multipart_threshold=8 * MB, multipart_chunksize=8 * MB, max_concurrency=4)
+    slots = threading.BoundedSemaphore(concurrency)
+    outcomes = {}
+
+    def upload(file_id: UUID, s3_key: str, fileobj):
+        try:
+            reader = _HashingReader(fileobj)
+            started = time.perf_counter()
+            s3_client.upload_fileobj(reader, bucket_name, s3_key, Config=config)
+            observe_transfer("ingest", reader.bytes_read, time.perf_counter() - started)
+            outcomes[file_id] = reader.hash.hexdigest()
+        except Exception as e:
+            outcomes[file_id] = e
+        finally:
+            fileobj.close()
+            slots.release()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for file_id, s3_key, open_source in sources:
+            slots.acquire()
+            try:
+                fileobj = open_source()
+            except Exception as e:
+                outcomes[file_id] = e
+                slots.release()
+                continue
+            executor.submit(upload, file_id, s3_key, fileobj)
+    return outcomes
+
+@app.post("/upload/batch", response_model=schemas.BatchUploadResponse)
+def upload_batch(db: Session = Depends(get_db), files: List[UploadFile] = File(...), renditions: Optional[str] = None,
+                 target_codec: Optional[models.Codec] = None, faststart: bool = False):
+    """Uploads many files in one request: video files, and zip / tar archives whose video members are ingested.
+    Files and Transactions rows are written in bulk and the files are uploaded to S3 concurrently.
+    Options apply to every file. Returns a result per file, a failed file does not fail the others."""
+    rendition_set = _parse_renditions(renditions)
+    bucket_name = os.getenv("S3_RAW_BUCKET")
+    archives = []
+    try:
+        # 1. List every file, expanding archives
+        sources = [] # (result index, file name, open callable)
+        results = []
+        for upload in files:
+            if not is_archive(upload.filename):
+                sources.append((len(results), upload.filename, lambda upload=upload: upload.file))
+                results.append({"file_name": upload.filename})
+                continue
+            try:
+                archive = ArchiveReader(upload.file, upload.filename)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            archives.append(archive)
+            for member in archive.members:
+                sources.append((len(results), os.path.basename(member), partial(archive.open, member)))
+                results.append({"file_name": os.path.basename(member)})
+            results += [{"file_name": member, "error": "Skipped: not a .mp4 or .mov file"} for member in archive.skipped]
+        max_files = int(os.getenv("INGEST_BATCH_MAX_FILES", "500"))
+        if len(sources) > max_files:
+            raise HTTPException(status_code=400, detail=f"At most {max_files} files per batch, got {len(sources)}.")
+
+        # 2. Create every File record and its UPLOAD transaction in one commit, before any S3 upload completes
+        records = []
+        for index, file_name, _ in sources:
+            file_id = uuid4()
+            records.append({
+                "file_id": file_id,
+                "file_name": file_name,
+                "raw_file_url": f"s3://{bucket_name}/{_raw_s3_key(file_name, file_id)}",
+                "rendition_set": rendition_set or None,
+                "target_codec": target_codec,
+                "faststart": faststart,
+            })
+            results[index]["file_id"] = file_id
+        if records:
+            crud.create_file_records(db, records)
+
+        # 3. Upload concurrently
+        outcomes = _upload_concurrently(get_s3_client(), bucket_name, [
+            (record["file_id"], _parse_s3_url(record["raw_file_url"])[1], open_source)
+            for record, (_, _, open_source) in zip(records, sources)
+        ])
+    finally:
+        for archive in archives:
+            archive.close()
+
+    # 4. Reuse cached results for identical content (one query), queue the rest in bulk
+    content_hashes = {file_id: outcome for file_id, outcome in outcomes.items() if isinstance(outcome, str)}
+    cached = {} if rendition_set else crud.get_completed_files_by_hashes(db, list(set(content_hashes.values())), target_codec, faststart)
+    statuses = {}
+    for file_id, outcome in outcomes.items():
+        if not isinstance(outcome, str):
+            crud.fail_upload(db, file_id, f"Upload failed: {str(outcome)}")
+            statuses[file_id] = (models.ProcessingStatus.FAILED, f"S3 upload failed: {str(outcome)}")
+        elif outcome in cached and crud.reuse_processed_output(db, file_id, cached[outcome]):
+            statuses[file_id] = (models.ProcessingStatus.COMPLETED, None)
+    queued = {file_id: content_hash for file_id, content_hash in content_hashes.items() if file_id not in statuses}
+    crud.queue_uploads(db, queued, commit=False)
+    _enqueue(db, [record["raw_file_url"] for record in records if record["file_id"] in queued])
+    db.commit()
+    for result in results:
+        if "file_id" in result:
+            result["processing_status"], result["error"] = statuses.get(result["file_id"], (models.ProcessingStatus.PENDING, None))
+    return {"results": results}
+
+# Direct-to-S3 multipart upload: the client PUTs parts straight to S3 with presigned URLs,
+# the API only handles metadata
+MB = 1024 * 1024
+S3_MIN_PART_SIZE = 5 * MB
+S3_MAX_PARTS = 10000
+S3_MAX_OBJECT_SIZE = 5 * 1024 * 1024 * MB # 5TB
+
+def _multipart_part_size(file_size: int) -> int:
+    part_size = max(int(os.getenv("MULTIPART_PART_SIZE_MB", "10")) * MB, S3_MIN_PART_SIZE)
+    # grow parts (in whole MB) for large files to stay within S3's 10,000 part limit
+    min_for_size = -(-file_size // S3_MAX_PARTS)
+    return max(part_size, -(-min_for_size // MB) * MB)
+
+@app.post("/upload/multipart", response_model=schemas.MultipartUploadResponse)
+def create_multipart_upload(request: schemas.MultipartUploadRequest, db: Session = Depends(get_db)):
+    if request.file_size > S3_MAX_OBJECT_SIZE:
+        raise HTTPException(status_code=400, detail="File exceeds the S3 maximum object size of 5TB.")
+    rendition_set = _parse_renditions(request.renditions)
+    s3_client = get_s3_client()
+    file_id = uuid4()
+    s3_key = _raw_s3_key(request.file_name, file_id)
+    bucket_name = os.getenv("S3_RAW_BUCKET")
+    raw_file_url = f"s3://{bucket_name}/{s3_key}"
+
+    # File record is created up front so it exists before the S3 event for the completed upload reaches the worker
+    crud.create_file_record(db, file_id, request.file_name, raw_file_url, rendition_set, request.target_codec, request.faststart,
+                            "Multipart upload initiated by user")
+
+    try:
+        upload_id = s3_client.create_multipart_upload(Bucket=bucket_name, Key=s3_key)["UploadId"]
+        part_size = _multipart_part_size(request.file_size)
+        part_count = -(-request.file_size // part_size)
+        parts = [
+            {
+                "part_number": part_number,
+                "upload_url": s3_client.generate_presigned_url(
+                    "upload_part",
+                    Params={"Bucket": bucket_name, "Key": s3_key, "UploadId": upload_id, "PartNumber": part_number},
+                    ExpiresIn=int(os.getenv("PRESIGNED_UPLOAD_EXPIRY", "3600")),
+                ),
+            }
+            for part_number in range(1, part_count + 1)
+        ]
+    except ClientError as e:
+        crud.fail_upload(db, file_id, f"Upload failed: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Could not create multipart upload: {e}")
+
+    return {"file_id": file_id, "s3_key": s3_key, "upload_id": upload_id, "part_size": part_size, "parts": parts}
+
+@app.post("/upload/{file_id}/multipart/complete", response_model=schemas.UploadResponse)
+def complete_multipart_upload(file_id: UUID, request: schemas.CompleteMultipartUploadRequest, db: Session = Depends(get_db)):
     db_file = _get_file(db, file_id)
+    if db_file.processing_status != models.ProcessingStatus.PENDING:
+        raise HTTPException(status_code=409, detail=f"Upload can not be completed. Current File status: {db_file.processing_status}")
+    bucket_name, s3_key = _parse_s3_url(db_file.raw_file_url)
+    parts = [{"PartNumber": part.part_number, "ETag": part.etag} for part in sorted(request.parts, key=lambda p: p.part_number)]
+
+    try:
+        get_s3_client().complete_multipart_upload(
+            Bucket=bucket_name, Key=s3_key, UploadId=request.upload_id, MultipartUpload={"Parts": parts}
+        )
+    except ClientError as e:
+        # Parts stay uploaded, client can fix the part list and retry or abort
+        raise HTTPException(status_code=400, detail=f"Could not complete multipart upload: {e}")
+
+    crud.create_transaction(db, file_id, models.TransactionType.PENDING, details="File upload complete, awaiting transcoding", commit=False)
+    _enqueue(db, [db_file.raw_file_url])
+    db.commit()
+    return db_file
+
+@app.post("/upload/{file_id}/multipart/abort", response_model=schemas.UploadResponse)
+def abort_multipart_upload(file_id: UUID, request: schemas.AbortMultipartUploadRequest, db: Session = Depends(get_db)):
+    db_file = _get_file(db, file_id)
+    bucket_name, s3_key = _parse_s3_url(db_file.raw_file_url)
+
+    try:
+        get_s3_client().abort_multipart_upload(Bucket=bucket_name, Key=s3_key, UploadId=request.upload_id)
+    except ClientError as e:
+        raise HTTPException(status_code=400, detail=f"Could not abort multipart upload: {e}")
+
+    crud.fail_upload(db, file_id, "Upload aborted by user")
+    db.refresh(db_file)
     return db_file
 
+@app.get("/upload/{file_id}/status", response_model=schemas.StatusResponse)
+def get_status(file_id: UUID):
+    status = _read_status(file_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail=f"File with ID {file_id} not found.")
+    return status
+
+@app.post("/upload/status/batch", response_model=schemas.BatchStatusResponse)
+def get_status_batch(request: schemas.BatchStatusRequest, db: Session = Depends(get_db)):
+    statuses = {}
+    for file_id in request.file_ids:
+        status = status_notifier.status_cache.get(str(file_id))
+        if status is not None:
+            statuses[file_id] = status
+    missing = [file_id for file_id in request.file_ids if file_id not in statuses]
+    if missing: # one IN query for everything not cached
+        for db_file in crud.get_files(db, missing):
+            statuses[db_file.file_id] = schemas.StatusResponse.model_validate(db_file).model_dump(mode="json")
+    return {
+        "statuses": _with_predictions([statuses[file_id] for file_id in dict.fromkeys(request.file_ids) if file_id in statuses]),
+        "not_found": [file_id for file_id in request.file_ids if file_id not in statuses],
+    }
+
+# Opaque keyset cursor: the (created_at, file_id) of the last row on the page
+def _encode_cursor(db_file: models.Files) -> str:
+    return base64.urlsafe_b64encode(f"{db_file.created_at.isoformat()}|{db_file.file_id}".encode()).decode()
+
+def _decode_cursor(cursor: str) -> tuple:
+    try:
+        created_at, file_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(created_at), UUID(file_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor.")
+
+@app.get("/uploads", response_model=schemas.FileListResponse)
+def list_uploads(processing_status: Optional[models.ProcessingStatus] = None, created_after: Optional[datetime] = None,
+                 created_before: Optional[datetime] = None, cursor: Optional[str] = None,
+                 limit: int = Query(50, ge=1, le=500), db: Session = Depends(get_db)):
+    """Files newest first, optionally filtered by status and creation time. Use `next_cursor` to page."""
+    files = crud.list_files(
+        db, processing_status, created_after, created_before, _decode_cursor(cursor) if cursor else None, limit
+    )
+    next_cursor = _encode_cursor(files[-1]) if len(files) == limit else None
+    items = [schemas.FileListItem.model_validate(db_file).model_dump(mode="json") for db_file in files]
+    return {"items": _with_predictions(items), "next_cursor": next_cursor}
+
+@app.get("/upload/{file_id}/history", response_model=schemas.FileHistoryResponse)
+def get_history(file_id: UUID, db: Session = Depends(get_db)):
+    """The file's state changes, oldest first. Older events are compacted or pruned by app.maintenance."""
+    _get_file(db, file_id) # 404 for unknown files, a known file may have had all its events pruned
+    return {"file_id": file_id, "events": crud.get_file_history(db, file_id)}
+
+@app.get("/uploads/backlog", response_model=schemas.BacklogResponse)
+def get_backlog(target_seconds: Optional[float] = Query(None, gt=0), db: Session = Depends(get_db)):
+    """Predicted time for the fleet's ENCODE_FLEET_SLOTS job slots to finish every pending and running job,
+    from the historical cost model. With `target_seconds`, also the slots needed to finish within it."""
+    backlog = _backlog(db)
+    work = backlog.pending_work_seconds + backlog.processing_remaining_seconds
+    return {
+        "pending_jobs": backlog.pending_jobs,
+        "processing_jobs": backlog.processing_jobs,
+        "pending_work_seconds": backlog.pending_work_seconds,
+        "processing_remaining_seconds": backlog.processing_remaining_seconds,
+        "fleet_slots": backlog.fleet_slots,
+        "drain_seconds": backlog.drain_seconds,
+        "drain_completed_at": _utcnow() + timedelta(seconds=backlog.drain_seconds),
+        "slots_needed": math.ceil(work / target_seconds) if target_seconds else None,
+        "throughput": list(_cost_model(db).fits.values()),
+    }
+
+STATUS_WAIT_MAX_TIMEOUT = float(os.getenv("STATUS_WAIT_MAX_TIMEOUT", "60"))
+
+@app.get("/upload/{file_id}/status/wait", response_model=schemas.StatusResponse)
+async def wait_for_status(file_id: UUID, current_status: Optional[models.ProcessingStatus] = None,
+                          timeout: float = Query(30, gt=0, le=STATUS_WAIT_MAX_TIMEOUT)):
+    """Long-poll: returns as soon as the status differs from `current_status` (default: the status when the
+    request arrives), or the unchanged status after `timeout` seconds."""
+    queue = status_notifier.subscribe(file_id) # subscribe before reading so no change is missed
+    try:
+        deadline = time.monotonic() + timeout
+        while True:
+            status = await asyncio.to_thread(_read_status, file_id)
+            if status is None:
+                raise HTTPException(status_code=404, detail=f"File with ID {file_id} not found.")
+            if current_status is None:
+                current_status = models.ProcessingStatus(status["processing_status"])
+            remaining = deadline - time.monotonic()
+            if status["processing_status"] != current_status.value or remaining <= 0:
+                return status
+            await status_notifier.wait_for_change(file_id, queue, remaining)
+    finally:
+        status_notifier.unsubscribe(file_id, queue)
+
+@app.get("/upload/{file_id}/status/stream")
+async def stream_status(file_id: UUID):
+    """Server-sent events: a `status` event with the StatusResponse on every status change,
+    until the file is completed or failed (or STATUS_STREAM_TIMEOUT passes)."""
+    queue = status_notifier.subscribe(file_id)
+    status = await asyncio.to_thread(_read_status, file_id)
+    if status is None:
+        status_notifier.unsubscribe(file_id, queue)
+        raise HTTPException(status_code=404, detail=f"File with ID {file_id} not found.")
+
+    async def events(status: dict):
+        keepalive = float(os.getenv("STATUS_STREAM_KEEPALIVE", "15"))
+        deadline = time.monotonic() + float(os.getenv("STATUS_STREAM_TIMEOUT", "3600"))
+        last_sent, last_write = None, time.monotonic()
+        try:
+            while status is not None:
+                if status != last_sent:
+                    yield f"event: status\ndata: {json.dumps(status)}\n\n"
+                    last_sent, last_write = status, time.monotonic()
+                elif time.monotonic() - last_write >= keepalive:
+                    yield ": keepalive\n\n" # SSE comment, keeps proxies from closing an idle stream
+                    last_write = time.monotonic()
+                remaining = deadline - time.monotonic()
+                if status["processing_status"] in TERMINAL_STATUSES or remaining <= 0:
+                    return
+                await status_notifier.wait_for_change(file_id, queue, min(remaining, keepalive))
+                status = await asyncio.to_thread(_read_status, file_id)
+        finally:
+            status_notifier.unsubscribe(file_id, queue)
+
+    return StreamingResponse(events(status), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
 @app.get("/upload/{file_id}/download/original", response_model=schemas.DownloadURLResponse)
-def download_original_file(file_id: UUID, db: Session = Depends(get_db)):
+def download_original_file(file_id: UUID, request: Request, proxy: Optional[bool] = None, db: Session = Depends(get_db)):
     db_file = _get_file(db, file_id)
-    url = _get_presigned_s3_url(db_file.raw_file_url, db_file.file_name)
-    return {"download_url": url}
+    return _download(request, db_file.raw_file_url, db_file.file_name, None, proxy)
 
 @app.get("/upload/{file_id}/download/processed", response_model=schemas.DownloadURLResponse)
-def download_processed_file(file_id: UUID, db: Session = Depends(get_db)):
+def download_processed_file(file_id: UUID, request: Request, proxy: Optional[bool] = None, db: Session = Depends(get_db)):
     db_file = _get_file(db, file_id)
     
     if db_file.processing_status != models.ProcessingStatus.COMPLETED:
@@ -119,5 +889,59 @@ def download_processed_file(file_id: UUID, db: Session = Depends(get_db)):
             detail=f"Processed file not available. Current File status: {db_file.processing_status}"
         )
     download_filename = f"processed-{db_file.file_name}"
-    url = _get_presigned_s3_url(db_file.processed_file_url, download_filename)
-    return {"download_url": url}
\ No newline at end of file
+    return _download(request, db_file.processed_file_url, download_filename, _output_version(db_file), proxy)
+
+@app.get("/upload/{file_id}/download/renditions/{rendition_name}", response_model=schemas.DownloadURLResponse)
+def download_rendition(file_id: UUID, rendition_name: str, request: Request, proxy: Optional[bool] = None, db: Session = Depends(get_db)):
+    db_file = _get_file(db, file_id)
+    rendition = next((r for r in db_file.renditions if r.name == rendition_name), None)
+    if rendition is None:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Rendition {rendition_name} not available. Current File status: {db_file.processing_status}"
+        )
+    download_filename = _rendition_download_name(db_file.file_name, rendition.name)
+    return _download(request, rendition.file_url, download_filename, db_file.completed_at, proxy)
+
+@app.get("/upload/{file_id}/download/poster", response_model=schemas.DownloadURLResponse)
+def download_poster(file_id: UUID, request: Request, proxy: Optional[bool] = None, db: Session = Depends(get_db)):
+    db_file = _get_file(db, file_id)
+    if not db_file.poster_url:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Poster not available. Current File status: {db_file.processing_status}"
+        )
+    download_filename = _preview_download_name(db_file.file_name, "poster")
+    return _download(request, db_file.poster_url, download_filename, _output_version(db_file), proxy)
+
+@app.get("/upload/{file_id}/download/sprite", response_model=schemas.DownloadURLResponse)
+def download_sprite(file_id: UUID, request: Request, proxy: Optional[bool] = None, db: Session = Depends(get_db)):
+    db_file = _get_file(db, file_id)
+    if not db_file.sprite_url:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Preview sprite not available. Current File status: {db_file.processing_status}"
+        )
+    download_filename = _preview_download_name(db_file.file_name, "sprite")
+    return _download(request, db_file.sprite_url, download_filename, _output_version(db_file), proxy)
+
+@app.delete("/upload/{file_id}", status_code=204)
+def delete_file(file_id: UUID, db: Session = Depends(get_db)):
+    db_file = _get_file(db, file_id)
+    if db_file.processing_status == models.ProcessingStatus.PROCESSING:
+        raise HTTPException(status_code=409, detail="File is being processed and can not be deleted.")
+    download_names = {None, db_file.file_name, f"processed-{db_file.file_name}"}
+    download_names.update(_rendition_download_name(db_file.file_name, r.name) for r in db_file.renditions)
+    download_names.update(_preview_download_name(db_file.file_name, kind) for kind in ("poster", "sprite"))
+
+    # S3 objects are only deleted once no File references them (processed outputs are shared by duplicate uploads)
+    for s3_url in crud.delete_file_record(db, file_id):
+        bucket_name, s3_key = _parse_s3_url(s3_url)
+        for download_name in download_names:
+            _presigned_url_cache.pop((bucket_name, s3_key, download_name))
+        if os.getpid() in _download_caches:
+            _download_caches[os.getpid()].evict(s3_url)
+        try:
+            get_s3_client().delete_object(Bucket=bucket_name, Key=s3_key)
+        except ClientError as e:
+            print(f"Failed to delete {s3_url}: {e}")
@@ -0,0 +1,58 @@
+import os
+import shutil
+import tarfile
+import tempfile
+import zipfile
+
+# Video files packed in an uploaded zip or tar archive (tar optionally gzip, bzip2 or xz compressed),
+# for POST /upload/batch. Directories, hidden files and anything that is not .mp4 / .mov are skipped.
+
+VIDEO_EXTENSIONS = (".mp4", ".mov")
+ARCHIVE_EXTENSIONS = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+MB = 1024 * 1024
+
+def is_archive(file_name: str) -> bool:
+    return file_name.lower().endswith(ARCHIVE_EXTENSIONS)
+
+def _is_video(member_name: str) -> bool:
+    base_name = os.path.basename(member_name)
+    return (
+        not base_name.startswith(".")
+        and "__MACOSX" not in member_name.split("/")
+        and os.path.splitext(base_name)[1].lower() in VIDEO_EXTENSIONS
+    )
+
+class ArchiveReader:
+    """Lists the video members of an archive, then hands out their contents in archive order.
+    Zip members are read straight from the archive: zipfile serializes reads of the shared file, so several members
+    can be uploaded concurrently. Tar members can only be read one after the other, each is copied to a spooled
+    temporary file (in memory up to INGEST_SPOOL_MEMORY_MB) so its upload can run while the next one is read.
+    Raises ValueError if the file is not a readable archive."""
+
+    def __init__(self, fileobj, file_name: str):
+        try:
+            if file_name.lower().endswith(".zip"):
+                self._zip = zipfile.ZipFile(fileobj)
+                self._tar = None
+                names = [info.filename for info in self._zip.infolist() if not info.is_dir()]
+            else:
+                self._zip = None
+                self._tar = tarfile.open(fileobj=fileobj, mode="r:*")
+                self._tar_members = {member.name: member for member in self._tar.getmembers() if member.isfile()}
+                names = list(self._tar_members)
+        except (zipfile.BadZipFile, tarfile.TarError) as e:
+            raise ValueError(f"Could not read archive {file_name}: {e}")
+        self.members = [name for name in names if _is_video(name)]
+        self.skipped = [name for name in names if not _is_video(name)]
+
+    def open(self, member_name: str):
+        """File object with the member's content. Not thread safe, open members from one thread."""
+        if self._zip is not None:
+            return self._zip.open(member_name)
+        spool = tempfile.SpooledTemporaryFile(max_size=int(os.getenv("INGEST_SPOOL_MEMORY_MB", "16")) * MB)
+        shutil.copyfileobj(self._tar.extractfile(self._tar_members[member_name]), spool, 1 * MB)
+        spool.seek(0)
+        return spool
+
+    def close(self):
+        (self._zip or self._tar).close()
@@ -0,0 +1,42 @@
+import os
+import threading
+import boto3
+from botocore.config import Config
+
+# Process-wide boto3 client registry shared by the API and worker.
+# Building a client is expensive (endpoint resolution, credential lookup, loading the botocore model)
+# and each client owns an HTTP connection pool, so clients are built once and reused.
+# Clients are keyed by pid as connection pools must not be shared across forked job processes.
+
+_clients = {}
+_lock = threading.Lock()
+
+def _client_kwargs(service: str) -> dict:
+    kwargs = {
+        "endpoint_url": os.getenv(f"{service.upper()}_ENDPOINT_URL") or None,
+        "config": Config(
+            max_pool_connections=int(os.getenv("AWS_MAX_POOL_CONNECTIONS", "50")),
+            retries={"max_attempts": 5, "mode": "standard"},
+            tcp_keepalive=True,
+        ),
+    }
+    if service == "sqs":
+        kwargs["region_name"] = os.getenv("AWS_REGION")
+    return kwargs
+
+def get_client(service: str):
+    key = (service, os.getpid())
+    client = _clients.get(key)
+    if client is None:
+        with _lock: # boto3's default session is not thread safe for client creation
+            client = _clients.get(key)
+            if client is None:
+                client = boto3.client(service, **_client_kwargs(service))
+                _clients[key] = client
+    return client
+
+def get_s3_client():
+    return get_client("s3")
+
+def get_sqs_client():
+    return get_client("sqs")
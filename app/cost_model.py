@@ -0,0 +1,116 @@
+import os
+from dataclasses import dataclass
+from typing import Optional
+
+from .models import Codec
+from .profiles import default_realtime_factor
+
+# Historical cost model: for each codec direction (original -> target codec) a least-squares fit of job processing time
+# (claim to finalize) against media duration: processing_time ~ overhead_seconds + seconds_per_media_second * duration.
+# The fit is kept as exponentially decayed regression sums in the encode_throughput table, updated incrementally by
+# every completed transcode in its finalize transaction (crud.record_throughput), so it follows hardware and profile
+# changes without refitting over the whole history. Until a direction has completed jobs, the
+# ENCODE_REALTIME_FACTOR_* estimates of profiles.py are used. Pending files get their duration when a worker's scheduler
+# probes their message (crud.save_probe_results); files not probed yet count as the mean job, or before any job
+# has completed as a COST_MODEL_DEFAULT_DURATION long one.
+
+def decay() -> float:
+    # weight kept by the existing sums on every new sample, ie the fit remembers roughly the last 1 / COST_MODEL_DECAY jobs
+    return 1.0 - float(os.getenv("COST_MODEL_DECAY", "0.05"))
+
+def default_job_duration() -> float:
+    # media seconds assumed for files not probed yet, until completed jobs give a mean
+    return float(os.getenv("COST_MODEL_DEFAULT_DURATION", "60"))
+
+def default_target_codec(original_codec: Codec) -> Optional[Codec]:
+    return {Codec.H264: Codec.HEVC, Codec.HEVC: Codec.H264}.get(original_codec)
+
+@dataclass(frozen=True)
+class ThroughputFit:
+    original_codec: Codec
+    target_codec: Codec
+    samples: float # decayed number of jobs
+    mean_seconds: float # mean processing time per job
+    overhead_seconds: float
+    seconds_per_media_second: float
+
+    def predict(self, duration: float = None) -> float:
+        if not duration:
+            return self.mean_seconds
+        return self.overhead_seconds + self.seconds_per_media_second * duration
+
+def fit_throughput(row) -> ThroughputFit:
+    """Least-squares line through the decayed sums of an EncodeThroughput row"""
+    n, sx, sy = row.weight, row.sum_duration, row.sum_time
+    denominator = n * row.sum_duration_sq - sx * sx
+    slope = (n * row.sum_duration_time - sx * sy) / denominator if denominator > 1e-6 * n * row.sum_duration_sq else 0.0
+    if slope <= 0:
+        # durations too alike to separate overhead from per-second cost, assume it is all per-second cost
+        slope = sy / sx if sx > 0 else 0.0
+    overhead = max((sy - slope * sx) / n, 0.0)
+    return ThroughputFit(row.original_codec, row.target_codec, n, sy / n, overhead, slope)
+
+class CostModel:
+    def __init__(self, rows):
+        self.fits = {(fit.original_codec, fit.target_codec): fit for fit in map(fit_throughput, rows) if fit.samples > 0}
+        weight = sum(fit.samples for fit in self.fits.values())
+        # for jobs not probed yet, whose codecs and duration are unknown
+        self.mean_job_seconds = sum(fit.mean_seconds * fit.samples for fit in self.fits.values()) / weight if weight else None
+
+    def predict(self, original_codec: Codec = None, target_codec: Codec = None, duration: float = None) -> float:
+        """Predicted processing seconds of one job"""
+        if original_codec is not None:
+            target_codec = target_codec or default_target_codec(original_codec)
+            fit = self.fits.get((original_codec, target_codec))
+            if fit is not None:
+                return fit.predict(duration)
+            if duration and target_codec is not None and target_codec != original_codec:
+                return duration / default_realtime_factor(target_codec)
+        if self.mean_job_seconds is not None:
+            return self.mean_job_seconds
+        # no history at all: a job of the default duration, in the requested codec or HEVC (the default for H.264 uploads)
+        return (duration or default_job_duration()) / default_realtime_factor(target_codec or Codec.HEVC)
+
+@dataclass(frozen=True)
+class BacklogEstimate:
+    pending_jobs: int
+    processing_jobs: int
+    pending_work_seconds: float # predicted processing seconds of all pending jobs
+    processing_remaining_seconds: float # predicted seconds left of the running jobs
+    fleet_slots: int
+
+    @property
+    def drain_seconds(self) -> float:
+        return (self.pending_work_seconds + self.processing_remaining_seconds) / self.fleet_slots
+
+    @property
+    def mean_pending_job_seconds(self) -> Optional[float]:
+        return self.pending_work_seconds / self.pending_jobs if self.pending_jobs else None
+
+def remaining_seconds(model: CostModel, job) -> float:
+    """Seconds left of a running job: from its live encode ETA when there is one, else predicted minus elapsed.
+    job: original_codec, target_codec, duration, elapsed_seconds, eta_seconds, progress_age_seconds"""
+    if job.eta_seconds is not None and job.progress_age_seconds is not None:
+        return max(job.eta_seconds - job.progress_age_seconds, 0.0)
+    predicted = model.predict(job.original_codec, job.target_codec, job.duration)
+    return max((predicted or 0.0) - (job.elapsed_seconds or 0.0), 0.0)
+
+def estimate_backlog(model: CostModel, pending_groups, processing_jobs, fleet_slots: int) -> BacklogEstimate:
+    """pending_groups: per (original_codec, target_codec) the number of pending jobs, how many were probed and their
+    total duration (crud.get_pending_work). processing_jobs: see remaining_seconds."""
+    pending_jobs = 0
+    pending_work = 0.0
+    for group in pending_groups:
+        pending_jobs += group.jobs
+        if group.probed_jobs:
+            # the fit is linear, so the mean duration gives the total over the group
+            mean_duration = (group.total_duration or 0.0) / group.probed_jobs
+            pending_work += group.probed_jobs * (model.predict(group.original_codec, group.target_codec, mean_duration) or 0.0)
+        pending_work += (group.jobs - group.probed_jobs) * (model.predict(group.original_codec, group.target_codec) or 0.0)
+    return BacklogEstimate(
+        pending_jobs=pending_jobs,
+        processing_jobs=len(processing_jobs),
+        pending_work_seconds=pending_work,
+        processing_remaining_seconds=sum(remaining_seconds(model, job) for job in processing_jobs),
+        fleet_slots=max(fleet_slots, 1),
+    )
@@ -1,45 +1,442 @@
-from sqlalchemy.orm import Session
+from sqlalchemy import update, insert, select, literal, func, String, tuple_, and_, or_, case
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session, selectinload
 from uuid import UUID
+from datetime import datetime, timedelta
 
 from . import models
+from .timing import STAGES
+from .cost_model import decay
 
-def create_file_record(db: Session, file_id: UUID, file_name: str, raw_file_url: str):
+def create_file_record(db: Session, file_id: UUID, file_name: str, raw_file_url: str, rendition_set: list = None,
+                       target_codec: models.Codec = None, faststart: bool = False, upload_details: str = "Upload started by user"):
+    """Creates the File with its UPLOAD transaction, in one commit."""
     db_file = models.Files(
         file_id = file_id,
         file_name = file_name,
         raw_file_url = raw_file_url,
+        rendition_set = rendition_set or None,
+        target_codec = target_codec,
+        faststart = faststart,
         processing_status = "PENDING" # default
     )
     db.add(db_file)
+    db.add(models.Transactions(file_id=file_id, type=models.TransactionType.UPLOAD, details=upload_details))
     db.commit()
     db.refresh(db_file)
     return db_file
 
-def create_transaction(db: Session, file_id: UUID, transaction_type: models.TransactionType, details: str = None):
-    db_transaction = models.Transactions(
-        file_id = file_id,
-        type = transaction_type,
-        details = details
+def create_file_records(db: Session, records: list, upload_details: str = "Batch upload started by user"):
+    """Inserts many Files ({file_id, file_name, raw_file_url, rendition_set, target_codec, faststart})
+    and their UPLOAD transactions with two executemany statements, in one commit."""
+    db.execute(insert(models.Files), [
+        {**record, "processing_status": models.ProcessingStatus.PENDING} for record in records
+    ])
+    create_transactions(db, [
+        {"file_id": record["file_id"], "type": models.TransactionType.UPLOAD, "details": upload_details} for record in records
+    ])
+
+def create_transaction(db: Session, file_id: UUID, transaction_type: models.TransactionType, details: str = None, commit: bool = True):
+    create_transactions(db, [{"file_id": file_id, "type": transaction_type, "details": details}], commit)
+
+def create_transactions(db: Session, transactions: list, commit: bool = True):
+    """Inserts many Transactions rows ({file_id, type, details}) in one executemany, instead of a commit per row."""
+    if transactions:
+        db.execute(insert(models.Transactions), transactions)
+    if commit:
+        db.commit()
+
+def queue_uploads(db: Session, content_hashes: dict, commit: bool = True):
+    """Records the content hash of each uploaded file (file_id -> hash) and its PENDING transaction, in one commit"""
+    if not content_hashes:
+        if commit:
+            db.commit()
+        return
+    # ORM bulk UPDATE by primary key, one executemany
+    db.execute(update(models.Files), [
+        {"file_id": file_id, "content_hash": content_hash} for file_id, content_hash in content_hashes.items()
+    ])
+    create_transactions(db, [
+        {"file_id": file_id, "type": models.TransactionType.PENDING, "details": "File upload complete, awaiting transcoding"}
+        for file_id in content_hashes
+    ], commit)
+
+def fail_upload(db: Session, file_id: UUID, details: str):
+    transition_file(db, file_id, models.TransactionType.FAILURE, details, processing_status=models.ProcessingStatus.FAILED)
+
+def get_file_history(db: Session, file_id: UUID) -> list:
+    # one range scan of ix_transactions_file_id_timestamp, already in timeline order
+    return db.scalars(
+        select(models.Transactions)
+        .where(models.Transactions.file_id == file_id)
+        .order_by(models.Transactions.timestamp)
+    ).all()
+
+# Probed media metadata plus the encoding profile chosen from it
+FILE_METADATA_FIELDS = ("original_codec", "duration", "width", "height", "bit_rate", "file_size", "streams", "encoding_profile")
+
+def update_file_metadata(db: Session, file_id: UUID, metadata: dict):
+    values = {field: metadata[field] for field in FILE_METADATA_FIELDS if field in metadata}
+    db.execute(update(models.Files).where(models.Files.file_id == file_id).values(**values))
+    db.commit()
+
+def save_probe_results(db: Session, results: dict):
+    """Probe metadata of files still waiting (file_id -> metadata), saved when the scheduler probes their messages
+    so completion predictions see the job size before the file is claimed. One commit."""
+    for file_id, metadata in results.items():
+        values = {field: metadata[field] for field in FILE_METADATA_FIELDS if field in metadata}
+        db.execute(
+            update(models.Files)
+            .where(models.Files.file_id == file_id, models.Files.processing_status == models.ProcessingStatus.PENDING)
+            .values(**values)
+        )
+    db.commit()
+
+def update_file_progress(db: Session, file_id: UUID, progress_percent: float, eta_seconds: float, encode_speed: float):
+    db.execute(
+        update(models.Files).where(models.Files.file_id == file_id).values(
+            progress_percent=progress_percent,
+            eta_seconds=eta_seconds,
+            encode_speed=encode_speed,
+            progress_updated_at=func.now(),
+        )
     )
-    db.add(db_transaction)
     db.commit()
 
+#### Job state transitions #####
+# Each transition is a single statement: the Files update and its Transactions row are written together
+# by a data-modifying CTE, so the state change and its audit row commit atomically in one round trip.
 
-def update_file_status(db: Session, file_id: UUID, status: models.ProcessingStatus):
-    db_file = get_file(db, file_id)
-    if db_file:
-        db_file.processing_status = status
+def _transition_statement(file_id: UUID, transaction_type: models.TransactionType, details: str, where: tuple = (), **values):
+    updated = (
+        update(models.Files)
+        .where(models.Files.file_id == file_id, *where)
+        .values(**values)
+        .returning(models.Files.file_id)
+        .cte("updated")
+    )
+    return insert(models.Transactions).from_select(
+        ["id", "file_id", "type", "details"],
+        select(
+            func.gen_random_uuid(),
+            updated.c.file_id,
+            literal(transaction_type, models.Transactions.type.type),
+            literal(details, String),
+        ),
+    ).returning(models.Transactions.file_id)
+
+def transition_file(db: Session, file_id: UUID, transaction_type: models.TransactionType, details: str = None, where: tuple = (),
+                    commit: bool = True, **values) -> bool:
+    """Updates the File with `values` (only if it matches `where`) and records a transaction, in one commit
+    (commit=False leaves it to the caller, to write more in the same transaction). Returns False if no File row matched."""
+    transitioned = db.execute(_transition_statement(file_id, transaction_type, details, where, **values)).first() is not None
+    if commit:
         db.commit()
+    return transitioned
+
+#### Worker leases #####
+# A claimed file is leased to one worker until lease_expires_at, renewed by the worker's heartbeat while it runs.
+# A file whose worker died keeps PROCESSING status with an expired lease, and can be claimed again.
+
+def _lease_expired(lease_seconds: float):
+    # rows claimed before leases existed expire lease_seconds after they were claimed
+    expires_at = func.coalesce(
+        models.Files.lease_expires_at, models.Files.processing_started_at + timedelta(seconds=lease_seconds)
+    )
+    return and_(models.Files.processing_status == models.ProcessingStatus.PROCESSING, expires_at < func.now())
+
+def _held_by(worker_id: str) -> tuple:
+    # transitions by a worker only apply while it still holds the lease, not after another worker took the file over
+    return (models.Files.worker_id == worker_id,) if worker_id else ()
+
+def claim_file(db: Session, file_id: UUID, worker_id: str = None, lease_seconds: float = 300):
+    """Atomically claims a PENDING file, or a PROCESSING file whose lease expired, with a conditional UPDATE ... RETURNING.
+    Returns the claimed File, or None if it does not exist or is not claimable (eg claimed by another worker)."""
+    db_file = db.scalars(
+        update(models.Files)
+        .where(
+            models.Files.file_id == file_id,
+            or_(models.Files.processing_status == models.ProcessingStatus.PENDING, _lease_expired(lease_seconds)),
+        )
+        .values(
+            processing_status=models.ProcessingStatus.PROCESSING,
+            processing_started_at=func.now(),
+            worker_id=worker_id,
+            lease_expires_at=func.now() + timedelta(seconds=lease_seconds),
+        )
+        .returning(models.Files)
+    ).first()
+    if db_file is None:
+        db.rollback()
+        return None
+    db.add(models.Transactions(file_id=file_id, type=models.TransactionType.PROCESSING, details=f"Started processing on {worker_id}"))
+    db.commit()
+    return db_file
+
+def renew_leases(db: Session, file_ids: list, worker_id: str, lease_seconds: float) -> int:
+    result = db.execute(
+        update(models.Files)
+        .where(
+            models.Files.file_id.in_(file_ids),
+            models.Files.processing_status == models.ProcessingStatus.PROCESSING,
+            models.Files.worker_id == worker_id,
+        )
+        .values(lease_expires_at=func.now() + timedelta(seconds=lease_seconds))
+    )
+    db.commit()
+    return result.rowcount
+
+def requeue_expired_leases(db: Session, lease_seconds: float, limit: int = 100, commit: bool = True) -> list:
+    """Moves PROCESSING files with an expired lease back to PENDING, recording a transaction for each.
+    Returns their (file_id, raw_file_url) so the caller can queue them again (before committing, with commit=False)."""
+    expired = select(models.Files.file_id).where(_lease_expired(lease_seconds)).limit(limit).with_for_update(skip_locked=True)
+    rows = db.execute(
+        update(models.Files)
+        .where(models.Files.file_id.in_(expired.scalar_subquery()))
+        .values(processing_status=models.ProcessingStatus.PENDING, worker_id=None, lease_expires_at=None)
+        .returning(models.Files.file_id, models.Files.raw_file_url)
+    ).all()
+    create_transactions(db, [
+        {"file_id": file_id, "type": models.TransactionType.PENDING, "details": "Worker lease expired, requeued"}
+        for file_id, _ in rows
+    ], commit)
+    return rows
+
+def fail_file(db: Session, file_id: UUID, details: str, worker_id: str = None):
+    transition_file(
+        db, file_id, models.TransactionType.FAILURE, details, where=_held_by(worker_id),
+        processing_status=models.ProcessingStatus.FAILED,
+        lease_expires_at=None,
+    )
 
 def get_file(db: Session, file_id: UUID):
     return db.query(models.Files).filter(models.Files.file_id == file_id).first()
 
-def finalize_file_on_completion(db: Session, file_id: UUID, processed_url: str, processing_time: float, original_codec: str, target_codec: str):
-    db_file = get_file(db, file_id)
-    if db_file:
-        db_file.processing_status = models.ProcessingStatus.COMPLETED
-        db_file.processed_file_url = processed_url
-        db_file.original_codec = original_codec
-        db_file.target_codec = target_codec
-        db_file.processing_time = processing_time
-        db.commit()
\ No newline at end of file
+def get_files(db: Session, file_ids: list) -> list:
+    return db.query(models.Files).options(selectinload(models.Files.renditions)).filter(models.Files.file_id.in_(file_ids)).all()
+
+def list_files(db: Session, status: models.ProcessingStatus = None, created_after: datetime = None, created_before: datetime = None,
+               cursor: tuple = None, limit: int = 50) -> list:
+    """Files newest first. `cursor` is the (created_at, file_id) of the last row of the previous page (keyset pagination),
+    so every page is an index range scan however deep it is."""
+    query = db.query(models.Files).options(selectinload(models.Files.renditions))
+    if status is not None:
+        query = query.filter(models.Files.processing_status == status)
+    if created_after is not None:
+        query = query.filter(models.Files.created_at >= created_after)
+    if created_before is not None:
+        query = query.filter(models.Files.created_at < created_before)
+    if cursor is not None:
+        query = query.filter(tuple_(models.Files.created_at, models.Files.file_id) < tuple_(*cursor))
+    return query.order_by(models.Files.created_at.desc(), models.Files.file_id.desc()).limit(limit).all()
+
+def _stage_values(stage_timings: dict) -> dict:
+    return {f"{stage}_seconds": seconds for stage, seconds in (stage_timings or {}).items() if stage in STAGES}
+
+def finalize_file_on_completion(db: Session, file_id: UUID, processed_url: str, processing_time: float, original_codec: str, target_codec: str,
+                                content_hash: str = None, stage_timings: dict = None, renditions: list = (), worker_id: str = None,
+                                preview_urls: dict = None, duration: float = None) -> bool:
+    """Completes the file, unless worker_id no longer holds its lease. Returns whether the file was completed.
+    preview_urls: poster_url / sprite_url of the uploaded previews, if any.
+    The job's processing time against its media duration updates the cost model, except for jobs with renditions."""
+    statement = _transition_statement(
+        file_id, models.TransactionType.COMPLETION, f"Completed in {processing_time:.2f}s", _held_by(worker_id),
+        processing_status=models.ProcessingStatus.COMPLETED,
+        processed_file_url=processed_url,
+        original_codec=original_codec,
+        target_codec=target_codec,
+        processing_time=processing_time,
+        completed_at=func.now(),
+        output_completed_at=func.now(),
+        progress_percent=100.0,
+        eta_seconds=0.0,
+        # files uploaded direct to S3 are hashed by the worker
+        content_hash=func.coalesce(models.Files.content_hash, content_hash),
+        lease_expires_at=None,
+        **_stage_values(stage_timings),
+        **(preview_urls or {}),
+    )
+    completed = db.execute(statement).first() is not None
+    if completed:
+        # flushed by the commit, in the same transaction as the completion
+        db.add_all(models.Renditions(file_id=file_id, **rendition) for rendition in renditions)
+        if duration and not renditions:
+            record_throughput(db, original_codec, target_codec, duration, processing_time)
+    db.commit()
+    return completed
+
+def _completed_outputs(db: Session, target_codec: models.Codec = None, faststart: bool = False):
+    query = db.query(models.Files).filter(
+        models.Files.processing_status == models.ProcessingStatus.COMPLETED,
+        models.Files.processed_file_url.isnot(None),
+    )
+    if target_codec is not None:
+        query = query.filter(models.Files.target_codec == target_codec)
+    else:
+        query = query.filter(models.Files.target_codec != models.Files.original_codec)
+    if faststart:
+        query = query.filter(models.Files.faststart.is_(True))
+    return query
+
+def get_completed_file_by_hash(db: Session, content_hash: str, exclude_file_id: UUID = None,
+                               target_codec: models.Codec = None, faststart: bool = False):
+    """A completed File with the same content whose output satisfies the requested target codec and container.
+    Without a target codec only outputs in the default (opposite) codec qualify."""
+    query = _completed_outputs(db, target_codec, faststart).filter(models.Files.content_hash == content_hash)
+    if exclude_file_id:
+        query = query.filter(models.Files.file_id != exclude_file_id)
+    return query.order_by(models.Files.created_at).first()
+
+def get_completed_files_by_hashes(db: Session, content_hashes: list, target_codec: models.Codec = None, faststart: bool = False) -> dict:
+    """get_completed_file_by_hash for many hashes in one query: content_hash -> oldest matching completed File"""
+    sources = {}
+    query = _completed_outputs(db, target_codec, faststart).filter(models.Files.content_hash.in_(content_hashes))
+    for db_file in query.order_by(models.Files.created_at):
+        sources.setdefault(db_file.content_hash, db_file)
+    return sources
+
+# Content-hash cache hit: point file_id at the processed output of an identical, already completed file
+def reuse_processed_output(db: Session, file_id: UUID, source: models.Files, worker_id: str = None) -> bool:
+    """Completes the File with the processed output of `source`, an identical completed upload.
+    Only applies while the File is PENDING (with SQS the worker may have claimed it already),
+    or with `worker_id` while that worker holds it.
+    The source row is locked FOR SHARE until the commit, so a concurrent delete_file_record of the source can not
+    free the shared output in between. Returns False if the source is gone or the File did not match."""
+    locked = db.scalar(
+        select(models.Files.file_id)
+        .where(
+            models.Files.file_id == source.file_id,
+            models.Files.processing_status == models.ProcessingStatus.COMPLETED,
+            models.Files.processed_file_url == source.processed_file_url,
+        )
+        .with_for_update(read=True)
+    )
+    if locked is None:
+        db.rollback()
+        return False
+    return transition_file(
+        db, file_id, models.TransactionType.COMPLETION, f"Cache hit: reused processed output of file {source.file_id}",
+        where=(
+            (models.Files.processing_status == models.ProcessingStatus.PROCESSING, *_held_by(worker_id)) if worker_id
+            else (models.Files.processing_status == models.ProcessingStatus.PENDING,)
+        ),
+        processing_status=models.ProcessingStatus.COMPLETED,
+        processed_file_url=source.processed_file_url,
+        original_codec=source.original_codec,
+        target_codec=source.target_codec,
+        processing_time=0.0,
+        completed_at=func.now(),
+        output_completed_at=source.output_completed_at or source.completed_at,
+        content_hash=source.content_hash,
+        poster_url=source.poster_url,
+        sprite_url=source.sprite_url,
+    )
+
+def delete_file_record(db: Session, file_id: UUID) -> list:
+    """Deletes the File record and returns the S3 urls it referenced that no other File references.
+    Processed outputs and previews are shared between files with the same content, so only the last reference frees them."""
+    # locked before the reference checks: a cache hit reusing this file's output holds it FOR SHARE until it commits,
+    # and the reference queries below then run after that commit and see the new reference
+    db_file = db.query(models.Files).filter(models.Files.file_id == file_id).with_for_update().first()
+    if not db_file:
+        return []
+    urls = [url for url in (db_file.raw_file_url, db_file.processed_file_url, db_file.poster_url, db_file.sprite_url) if url]
+    # renditions belong to this file only
+    orphaned = [rendition.file_url for rendition in db_file.renditions]
+    db.query(models.Renditions).filter(models.Renditions.file_id == file_id).delete()
+    for url in urls:
+        # lock every row referencing url so concurrent deletes of files sharing it are serialized
+        referencing = db.query(models.Files).filter(
+            (models.Files.raw_file_url == url) | (models.Files.processed_file_url == url)
+            | (models.Files.poster_url == url) | (models.Files.sprite_url == url)
+        ).with_for_update().all()
+        if all(f.file_id == file_id for f in referencing):
+            orphaned.append(url)
+    db.delete(db_file)
+    db.commit()
+    return orphaned
+
+#### Cost model #####
+# Inputs of cost_model.py: decayed throughput sums per codec direction, and the pending and running work
+
+def record_throughput(db: Session, original_codec: models.Codec, target_codec: models.Codec, duration: float, processing_time: float):
+    """Decays the direction's regression sums and adds one job, in a single upsert. Not committed."""
+    table = models.EncodeThroughput
+    keep = decay()
+    sample = {
+        "weight": 1.0,
+        "sum_duration": duration,
+        "sum_time": processing_time,
+        "sum_duration_sq": duration * duration,
+        "sum_duration_time": duration * processing_time,
+    }
+    statement = pg_insert(table).values(original_codec=original_codec, target_codec=target_codec, **sample)
+    db.execute(statement.on_conflict_do_update(
+        index_elements=[table.original_codec, table.target_codec],
+        set_={**{column: getattr(table, column) * keep + value for column, value in sample.items()}, "updated_at": func.now()},
+    ))
+
+def get_throughput(db: Session) -> list:
+    return db.query(models.EncodeThroughput).all()
+
+def get_pending_work(db: Session) -> list:
+    # pending jobs per direction; unprobed jobs have no original_codec or duration yet
+    return db.execute(
+        select(
+            models.Files.original_codec,
+            models.Files.target_codec,
+            func.count().label("jobs"),
+            func.count(models.Files.duration).label("probed_jobs"),
+            func.sum(models.Files.duration).label("total_duration"),
+        )
+        .where(models.Files.processing_status == models.ProcessingStatus.PENDING)
+        .group_by(models.Files.original_codec, models.Files.target_codec)
+    ).all()
+
+def get_processing_jobs(db: Session) -> list:
+    def seconds_since(column):
+        return func.extract("epoch", func.now() - column)
+    return db.execute(
+        select(
+            models.Files.original_codec,
+            models.Files.target_codec,
+            models.Files.duration,
+            models.Files.eta_seconds,
+            seconds_since(models.Files.processing_started_at).label("elapsed_seconds"),
+            # progress left over from an earlier attempt of a requeued file does not count
+            case(
+                (models.Files.progress_updated_at >= models.Files.processing_started_at, seconds_since(models.Files.progress_updated_at)),
+            ).label("progress_age_seconds"),
+        )
+        .where(models.Files.processing_status == models.ProcessingStatus.PROCESSING)
+    ).all()
+
+def count_pending_before_each(db: Session, positions: list) -> dict:
+    """count_pending_before for many pending files ((created_at, file_id) pairs) in one query: file_id -> count.
+    Numbers the pending files up to the latest of them, on the same index."""
+    if not positions:
+        return {}
+    ranked = (
+        select(
+            models.Files.file_id,
+            (func.row_number().over(order_by=(models.Files.created_at, models.Files.file_id)) - 1).label("ahead"),
+        )
+        .where(
+            models.Files.processing_status == models.ProcessingStatus.PENDING,
+            tuple_(models.Files.created_at, models.Files.file_id) <= tuple_(*max(positions)),
+        )
+        .subquery()
+    )
+    file_ids = [file_id for _, file_id in positions]
+    return dict(db.execute(select(ranked.c.file_id, ranked.c.ahead).where(ranked.c.file_id.in_(file_ids))).all())
+
+def count_pending_before(db: Session, created_at: datetime, file_id: UUID) -> int:
+    # pending files uploaded earlier, counted on ix_files_status_created_at_file_id
+    return db.scalar(
+        select(func.count())
+        .select_from(models.Files)
+        .where(
+            models.Files.processing_status == models.ProcessingStatus.PENDING,
+            tuple_(models.Files.created_at, models.Files.file_id) < tuple_(created_at, file_id),
+        )
+    )
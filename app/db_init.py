@@ -1,9 +1,95 @@
 import time
+from sqlalchemy import inspect, text
 from sqlalchemy.exc import OperationalError
+from sqlalchemy.types import SchemaType
 
 # We must import all models so that Base knows about them
 from .database import engine, Base
-from .models import Files, Transactions, Codec, ProcessingStatus, TransactionType
+from .models import Files, Transactions, Renditions, EncodeThroughput, Jobs, Codec, ProcessingStatus, TransactionType
+from .notify import STATUS_CHANNEL
+from .queues import JOB_CHANNEL
+from .timing import STAGES
+
+# Files columns returned by the status endpoints that change while a job runs, a change sends NOTIFY file_status
+STATUS_NOTIFY_COLUMNS = (
+    "processing_status", "progress_percent",
+    "original_codec", "duration", "width", "height", "bit_rate", "file_size", "encoding_profile",
+    *(f"{stage}_seconds" for stage in STAGES),
+)
+
+# Indexes of earlier schema versions made redundant by newer ones, dropped so inserts stop maintaining them
+SUPERSEDED_INDEXES = (
+    "ix_transactions_file_id", # by ix_transactions_file_id_timestamp
+)
+
+def upgrade_schema():
+    # create_all only creates missing tables. Add the columns and indexes added to the models since
+    # an existing database was created, so it keeps working without `docker-compose down --volumes`
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+                if isinstance(column.type, SchemaType): # eg postgres ENUM types
+                    column.type.create(conn, checkfirst=True)
+                column_type = column.type.compile(dialect=engine.dialect)
+                print(f"--- ADDING COLUMN {table.name}.{column.name} ---")
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+        for index_name in SUPERSEDED_INDEXES:
+            conn.execute(text(f"DROP INDEX IF EXISTS {index_name}"))
+
+def install_status_notify_trigger():
+    # Every status, progress, probe metadata or stage timing change (worker or api) sends NOTIFY file_status with the
+    # file's new status, in the same transaction as the change. The api LISTENs to push status updates to waiting clients
+    # and to invalidate its status cache.
+    if engine.dialect.name != "postgresql":
+        return
+    with engine.begin() as conn:
+        conn.execute(text(f"""
+            CREATE OR REPLACE FUNCTION notify_file_status() RETURNS trigger AS $$
+            BEGIN
+                PERFORM pg_notify('{STATUS_CHANNEL}', json_build_object(
+                    'file_id', NEW.file_id, 'processing_status', NEW.processing_status
+                )::text);
+                RETURN NEW;
+            END;
+            $$ LANGUAGE plpgsql
+        """))
+        conn.execute(text("DROP TRIGGER IF EXISTS files_status_notify ON files"))
+        changed = " OR ".join(f"OLD.{column} IS DISTINCT FROM NEW.{column}" for column in STATUS_NOTIFY_COLUMNS)
+        conn.execute(text(f"""
+            CREATE TRIGGER files_status_notify
+            AFTER UPDATE OF {", ".join(STATUS_NOTIFY_COLUMNS)} ON files
+            FOR EACH ROW WHEN ({changed})
+            EXECUTE FUNCTION notify_file_status()
+        """))
+
+def install_job_notify_trigger():
+    # New jobs of the postgres queue backend wake the workers waiting in PostgresQueue.receive, one NOTIFY per insert statement
+    if engine.dialect.name != "postgresql":
+        return
+    with engine.begin() as conn:
+        conn.execute(text(f"""
+            CREATE OR REPLACE FUNCTION notify_job_queue() RETURNS trigger AS $$
+            BEGIN
+                PERFORM pg_notify('{JOB_CHANNEL}', '');
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+        """))
+        conn.execute(text("DROP TRIGGER IF EXISTS jobs_notify ON jobs"))
+        conn.execute(text("""
+            CREATE TRIGGER jobs_notify
+            AFTER INSERT ON jobs
+            FOR EACH STATEMENT
+            EXECUTE FUNCTION notify_job_queue()
+        """))
 
 def main():
     # Checks that DB PostgreSQL is ready before api and worker containers connects to db container
@@ -20,6 +106,9 @@ def main():
             # Try to establish a connection and create tables
             # if tables already exist, wont recreate
             Base.metadata.create_all(bind=engine)
+            upgrade_schema()
+            install_status_notify_trigger()
+            install_job_notify_trigger()
             db_ready = True
             print("--- DATABASE IS READY AND TABLES ARE CREATED ---")
         except OperationalError as e:
@@ -0,0 +1,80 @@
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from typing import Optional
+from uuid import uuid4
+
+# Local disk cache of the S3 objects served by the download proxy (see api._proxy_download).
+# Entries are keyed by S3 URL and remember the version they were cached for, the completion time of the job that wrote
+# the object: a reprocessed file is written to the same key with a new one, so a lookup with another version drops the stale entry.
+# Least recently used entries are evicted to keep the total under max_bytes. The index is in memory, so each
+# api process has its own directory, emptied when the cache is created.
+
+class DiskCache:
+    def __init__(self, directory: str, max_bytes: int, max_object_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_object_bytes = min(max_object_bytes, max_bytes)
+        self._entries = OrderedDict() # s3_url -> (version, path, size)
+        self._size = 0
+        self._filling = set() # s3_urls being downloaded
+        self._lock = threading.Lock()
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory, exist_ok=True)
+
+    def open(self, s3_url: str, version) -> Optional[tuple]:
+        """(open file, size) of a cached object, None on a miss. The file stays readable if the entry is evicted
+        while it is served: eviction unlinks, open files keep their data."""
+        with self._lock:
+            entry = self._entries.get(s3_url)
+            if entry is None:
+                return None
+            if entry[0] != version:
+                self._remove(s3_url)
+                return None
+            self._entries.move_to_end(s3_url)
+            _, path, size = entry
+            return open(path, "rb"), size
+
+    def fill(self, s3_url: str, version, size: int, download):
+        """Caches an object, download(path) writes it to path. Objects over max_object_bytes and objects already
+        being cached are skipped."""
+        if size > self.max_object_bytes:
+            return
+        with self._lock:
+            if s3_url in self._filling:
+                return
+            self._filling.add(s3_url)
+        path = os.path.join(self.directory, uuid4().hex)
+        try:
+            download(path)
+            with self._lock:
+                self._remove(s3_url)
+                self._entries[s3_url] = (version, path, size)
+                self._size += size
+                while self._size > self.max_bytes:
+                    self._remove(next(iter(self._entries)))
+        except Exception as e:
+            print(f"Failed to cache {s3_url}: {e}")
+            _unlink(path)
+        finally:
+            with self._lock:
+                self._filling.discard(s3_url)
+
+    def evict(self, s3_url: str):
+        with self._lock:
+            self._remove(s3_url)
+
+    def _remove(self, s3_url: str):
+        # caller holds the lock
+        entry = self._entries.pop(s3_url, None)
+        if entry is not None:
+            self._size -= entry[2]
+            _unlink(entry[1])
+
+def _unlink(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
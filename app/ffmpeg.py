@@ -0,0 +1,103 @@
+import subprocess
+import threading
+from collections import deque
+
+from .models import Codec
+from .profiles import EncodingProfile, default_profile
+
+class FFmpegProgress:
+    """Parses ffmpeg's machine-readable `-progress` output (blocks of key=value lines ending in progress=...)
+    and calls on_progress(out_time_seconds, fps, speed) once per block."""
+
+    def __init__(self, on_progress=None):
+        self.on_progress = on_progress
+        self._block = {}
+
+    def feed(self, line: str) -> bool:
+        # Returns False for lines that are not progress output (eg ffmpeg errors on a shared stderr)
+        key, sep, value = line.strip().partition("=")
+        if not sep or " " in key:
+            return False
+        self._block[key] = value.strip()
+        if key == "progress":
+            if self.on_progress:
+                self.on_progress(self._out_time(), _to_float(self._block.get("fps")), _to_float(self._block.get("speed", "").rstrip("x")))
+            self._block = {}
+        return True
+
+    def _out_time(self) -> float:
+        # out_time_us, and out_time_ms which despite the name is also microseconds
+        micros = _to_float(self._block.get("out_time_us") or self._block.get("out_time_ms"))
+        return max(micros or 0.0, 0.0) / 1_000_000
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None # eg N/A before the first frame
+
+# Progress as key=value on the given pipe, no periodic stats line, and only errors logged
+def progress_args(pipe: str = "pipe:1") -> list:
+    return ["-nostats", "-loglevel", "error", "-progress", pipe]
+
+def _collect_stderr(stderr, tail: deque):
+    for line in stderr:
+        line = line.strip()
+        if line:
+            print(f"[ffmpeg] {line}")
+            tail.append(line)
+
+def ffmpeg_popen(command, on_progress=None):
+    print(f"ffmpeg_popen {command[-1]}")
+    # execute with Popen, ffmpeg writes progress blocks to stdout; stderr only has errors, kept for the failure message
+    command = [command[0], *progress_args("pipe:1"), *command[1:]]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               text=True, bufsize=1, universal_newlines=True)
+    stderr_tail = deque(maxlen=20)
+    stderr_reader = threading.Thread(target=_collect_stderr, args=(process.stderr, stderr_tail), daemon=True)
+    stderr_reader.start()
+    progress = FFmpegProgress(on_progress)
+    for line in process.stdout:
+        progress.feed(line)
+    # Wait for the process to complete and check its return code
+    process.wait()
+    stderr_reader.join()
+    if process.returncode != 0:
+        # If ffmpeg failed, raise an error
+        errors = " | ".join(stderr_tail)
+        raise RuntimeError(f"FFmpeg failed with exit code {process.returncode} writing {command[-1]}: {errors}")
+
+# Video encoder settings for each target codec, with the preset, CRF and threads of the job's encoding profile
+def video_encoder_args(target_codec: Codec, profile: EncodingProfile = None) -> list:
+    if target_codec not in (Codec.H264, Codec.HEVC):
+        raise RuntimeError(f"Unsupported target codec '{target_codec}' for transcoding.")
+    profile = profile or default_profile(target_codec)
+    if target_codec == Codec.H264:
+        args = ["-c:v", "libx264", "-preset", profile.preset, "-crf", str(profile.crf)] # libx264 encoder
+        if profile.threads:
+            args += ["-threads", str(profile.threads)]
+        return args
+    args = ["-c:v", "libx265", "-preset", profile.preset, "-crf", str(profile.crf), "-vtag", "hvc1"] # libx265 encoder
+    if profile.threads:
+        args += ["-x265-params", f"pools={profile.threads}"] # libx265 sizes its thread pool itself, ignoring -threads
+    return args
+
+# moov atom before mdat so players can start before the whole file is downloaded (progressive download)
+def container_args(faststart: bool = False) -> list:
+    return ["-movflags", "+faststart"] if faststart else []
+
+def transcode_to_h264(input_path: str, output_path: str, on_progress=None, profile: EncodingProfile = None, faststart: bool = False):
+    print(f"Transcoding from HEVC to H.264")
+    command = ["ffmpeg", "-i", input_path, *video_encoder_args(Codec.H264, profile), "-c:a", "copy", *container_args(faststart), output_path]
+    ffmpeg_popen(command, on_progress)
+    
+def transcode_to_h265(input_path: str, output_path: str, on_progress=None, profile: EncodingProfile = None, faststart: bool = False):
+    print(f"Transcoding from H.264 to HEVC")
+    command = ["ffmpeg", "-i", input_path, *video_encoder_args(Codec.HEVC, profile), "-c:a", "copy", *container_args(faststart), output_path]
+    ffmpeg_popen(command, on_progress)
+
+# Source already in the target codec: stream copy into a new container, no decode or encode
+def remux(input_path: str, output_path: str, on_progress=None):
+    print("Remuxing with stream copy")
+    command = ["ffmpeg", "-i", input_path, "-map", "0:v", "-map", "0:a?", "-c", "copy", *container_args(True), output_path]
+    ffmpeg_popen(command, on_progress)
@@ -0,0 +1,77 @@
+import os
+import socket
+import threading
+import time
+from urllib.parse import urlparse
+
+from . import crud
+from .database import SessionLocal
+from .queues import s3_event_body, visibility_timeout
+
+# Keeps long jobs owned by the worker running them:
+# - the heartbeat extends the queue visibility timeout of every received message still held (buffered or running),
+#   so a long encode is not redelivered halfway through, and renews the File leases of the running jobs
+# - the reaper moves files whose worker stopped renewing (crashed, killed) back to PENDING and queues them again
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+def lease_seconds() -> float:
+    return float(os.getenv("JOB_LEASE_SECONDS", "300"))
+
+def _event_body(raw_file_url: str) -> dict:
+    # the same event S3 sends when the raw file is created
+    parsed = urlparse(raw_file_url)
+    return s3_event_body(parsed.netloc, parsed.path.lstrip("/"))
+
+class LeaseKeeper(threading.Thread):
+    def __init__(self, queue, held_jobs):
+        super().__init__(name="lease-keeper", daemon=True)
+        self.queue = queue # see queues.py
+        self.held_jobs = held_jobs # callable returning (message, file_id or None, running) for every held message
+        # renew well within both timeouts so one failed heartbeat does not lose the message or the lease
+        self.interval = min(visibility_timeout(), lease_seconds()) / 3
+        self.reap_interval = float(os.getenv("LEASE_REAPER_INTERVAL", "60"))
+        self._last_reap = 0.0
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.heartbeat()
+                if self.reap_interval and time.monotonic() - self._last_reap >= self.reap_interval:
+                    self._last_reap = time.monotonic()
+                    self.reap()
+            except Exception as e:
+                print(f"Lease heartbeat failed: {e}")
+
+    def heartbeat(self):
+        jobs = list(self.held_jobs())
+        for failure in self.queue.extend_visibility([message for message, _, _ in jobs], visibility_timeout()):
+            # eg the job finished and deleted its message in the meantime
+            print(f"Could not extend visibility: {failure}")
+
+        file_ids = [file_id for _, file_id, running in jobs if running and file_id]
+        if file_ids:
+            db = SessionLocal()
+            try:
+                renewed = crud.renew_leases(db, file_ids, WORKER_ID, lease_seconds())
+            finally:
+                db.close()
+            if renewed < len(file_ids):
+                print(f"Renewed {renewed} of {len(file_ids)} leases, the rest are not processing or were taken over")
+
+    def reap(self):
+        # the jobs are sent before the requeue commits: if sending fails the files keep their expired lease and
+        # the next reap retries, rather than being left PENDING with no message
+        db = SessionLocal()
+        try:
+            expired = crud.requeue_expired_leases(db, lease_seconds(), commit=False)
+            if expired:
+                print(f"Leases of {[str(file_id) for file_id, _ in expired]} expired, requeueing")
+                self.queue.send_batch([_event_body(raw_file_url) for _, raw_file_url in expired])
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            print(f"Failed to requeue expired leases: {e}")
+        finally:
+            db.close()
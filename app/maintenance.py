@@ -0,0 +1,83 @@
+import os
+import time
+from datetime import timedelta
+
+from sqlalchemy import and_, delete, exists, func, select
+from sqlalchemy.orm import Session
+
+from . import models
+from .database import SessionLocal
+
+# Retention and compaction of the Transactions audit log, in place of partitioning the table:
+# - rows older than TRANSACTION_RETENTION_DAYS are deleted, including the history of deleted files
+# - PENDING / PROCESSING rows older than TRANSACTION_COMPACT_AFTER_DAYS of completed or failed files are deleted,
+#   keeping the upload and the outcome (lease requeues and retries add intermediate rows)
+# Rows are deleted in batches of TRANSACTION_MAINTENANCE_BATCH_SIZE, each in its own short transaction,
+# so no long locks are held and autovacuum reclaims the space as it goes. Batches skip rows locked by
+# another run, so overlapping runs are safe.
+# Run with `python -m app.maintenance`: every TRANSACTION_MAINTENANCE_INTERVAL seconds, or once if 0.
+
+FINISHED_STATUSES = (models.ProcessingStatus.COMPLETED, models.ProcessingStatus.FAILED)
+INTERMEDIATE_TYPES = (models.TransactionType.PENDING, models.TransactionType.PROCESSING)
+
+def _batch_size() -> int:
+    return int(os.getenv("TRANSACTION_MAINTENANCE_BATCH_SIZE", "5000"))
+
+def _delete_in_batches(db: Session, condition, batch_size: int) -> int:
+    deleted = 0
+    while True:
+        batch = select(models.Transactions.id).where(condition).limit(batch_size).with_for_update(skip_locked=True)
+        count = db.execute(
+            delete(models.Transactions).where(models.Transactions.id.in_(batch.scalar_subquery()))
+        ).rowcount
+        db.commit()
+        deleted += count
+        if count < batch_size:
+            return deleted
+
+def prune_transactions(db: Session, retention_days: float, batch_size: int = 5000) -> int:
+    """Deletes transactions older than retention_days. Returns the number of rows deleted."""
+    older = models.Transactions.timestamp < func.now() - timedelta(days=retention_days)
+    return _delete_in_batches(db, older, batch_size)
+
+def compact_transactions(db: Session, compact_after_days: float, batch_size: int = 5000) -> int:
+    """Deletes the intermediate transactions older than compact_after_days of files that finished.
+    Returns the number of rows deleted."""
+    finished = exists().where(
+        models.Files.file_id == models.Transactions.file_id,
+        models.Files.processing_status.in_(FINISHED_STATUSES),
+    )
+    condition = and_(
+        models.Transactions.type.in_(INTERMEDIATE_TYPES),
+        models.Transactions.timestamp < func.now() - timedelta(days=compact_after_days),
+        finished,
+    )
+    return _delete_in_batches(db, condition, batch_size)
+
+def run_maintenance():
+    db = SessionLocal()
+    try:
+        retention_days = float(os.getenv("TRANSACTION_RETENTION_DAYS", "90"))
+        compact_after_days = float(os.getenv("TRANSACTION_COMPACT_AFTER_DAYS", "7"))
+        if retention_days:
+            print(f"Pruned {prune_transactions(db, retention_days, _batch_size())} transactions older than {retention_days} days")
+        if compact_after_days:
+            print(f"Compacted {compact_transactions(db, compact_after_days, _batch_size())} intermediate transactions")
+    finally:
+        db.close()
+
+def main():
+    interval = float(os.getenv("TRANSACTION_MAINTENANCE_INTERVAL", "3600"))
+    while True:
+        try:
+            run_maintenance()
+        except Exception as e:
+            print(f"Transaction maintenance failed: {e}")
+            if not interval:
+                raise
+        if not interval:
+            return
+        time.sleep(interval)
+
+if __name__ == "__main__":
+    main()
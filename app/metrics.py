@@ -0,0 +1,83 @@
+import os
+import time
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Histogram, generate_latest, start_http_server
+from prometheus_client import REGISTRY, multiprocess
+from sqlalchemy import event
+
+from .database import SessionLocal
+
+# Prometheus histograms for the API (GET /metrics) and the worker (sidecar port WORKER_METRICS_PORT).
+# Worker jobs run in pool processes: with PROMETHEUS_MULTIPROC_DIR set each process writes its samples there
+# and the scrape aggregates them. The directory must exist and be emptied before the service starts.
+
+MB = 1024 * 1024
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "transcoder_http_request_duration_seconds", "API request handling time",
+    ["method", "route", "status"], buckets=SECONDS_BUCKETS,
+)
+JOB_STAGE_SECONDS = Histogram(
+    "transcoder_job_stage_seconds", "Seconds spent in each worker job stage, see timing.STAGES",
+    ["stage"], buckets=SECONDS_BUCKETS,
+)
+ENCODE_REALTIME_FACTOR = Histogram(
+    "transcoder_encode_realtime_factor", "Media seconds encoded per wall-clock second",
+    ["target_codec"], buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32),
+)
+S3_TRANSFER_SECONDS = Histogram(
+    "transcoder_s3_transfer_seconds", "Duration of S3 object transfers",
+    ["operation"], buckets=SECONDS_BUCKETS,
+)
+S3_TRANSFER_BYTES = Histogram(
+    "transcoder_s3_transfer_bytes", "Size of S3 object transfers",
+    ["operation"], buckets=tuple(n * MB for n in (1, 4, 16, 64, 256, 1024, 4096, 16384)),
+)
+DOWNLOAD_CACHE_REQUESTS = Counter(
+    "transcoder_download_cache_requests", "Proxied downloads by disk cache result (hit, miss)",
+    ["result"],
+)
+DB_COMMIT_SECONDS = Histogram(
+    "transcoder_db_commit_seconds", "Session commit latency, including the flush",
+    buckets=SECONDS_BUCKETS,
+)
+
+def observe_transfer(operation: str, size: int, seconds: float):
+    # operation: ingest (client -> raw bucket via the API), download (raw -> worker), upload (worker -> processed),
+    # proxy (S3 -> download proxy disk cache)
+    S3_TRANSFER_BYTES.labels(operation).observe(size)
+    S3_TRANSFER_SECONDS.labels(operation).observe(seconds)
+
+@event.listens_for(SessionLocal, "before_commit")
+def _commit_started(session):
+    session.info["commit_started"] = time.perf_counter()
+
+@event.listens_for(SessionLocal, "after_commit")
+def _commit_finished(session):
+    started = session.info.pop("commit_started", None)
+    if started is not None:
+        DB_COMMIT_SECONDS.observe(time.perf_counter() - started)
+
+def _registry():
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+def render_metrics():
+    """(body, content type) for a /metrics response"""
+    return generate_latest(_registry()), CONTENT_TYPE_LATEST
+
+def start_metrics_server():
+    port = int(os.getenv("WORKER_METRICS_PORT", "9100"))
+    if not port:
+        return
+    try:
+        start_http_server(port, registry=_registry())
+    except OSError as e:
+        # eg the port is taken by another worker on the same host, jobs run the same without metrics
+        print(f"Could not serve metrics on :{port}, continuing without: {e}")
+        return
+    print(f"Serving metrics on :{port}/metrics")
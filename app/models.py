@@ -1,5 +1,6 @@
-from sqlalchemy import Column, String, DateTime, func, Enum, Float
+from sqlalchemy import Column, String, DateTime, func, Enum, Float, Integer, BigInteger, Boolean, JSON, Index
 from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.orm import relationship
 import enum
 import uuid
 from .database import Base
@@ -20,13 +21,68 @@ class Files(Base):
     file_name = Column(String, index=True)
     processing_status = Column(Enum(ProcessingStatus), default=ProcessingStatus.PENDING)
     raw_file_url = Column(String)
-    processed_file_url = Column(String, nullable=True)
+    processed_file_url = Column(String, nullable=True, index=True) # may be shared by files with the same content_hash
+    content_hash = Column(String, nullable=True, index=True) # sha256 of the uploaded file
+    poster_url = Column(String, nullable=True) # jpg previews next to the processed file, shared like processed_file_url
+    sprite_url = Column(String, nullable=True) # SPRITE_COLUMNS x SPRITE_ROWS grid of evenly spaced thumbnails
 
     original_codec = Column(Enum(Codec), nullable=True)
-    target_codec = Column(Enum(Codec), nullable=True)
+    target_codec = Column(Enum(Codec), nullable=True) # requested at upload, else the opposite of original_codec
+    faststart = Column(Boolean, nullable=True) # processed output must have its moov atom first, requested at upload
     processing_time = Column(Float, nullable=True)
+    processing_started_at = Column(DateTime, nullable=True) # set when a worker claims the job
+    worker_id = Column(String, nullable=True) # host:pid of the worker holding the job's lease
+    lease_expires_at = Column(DateTime, nullable=True) # renewed by the worker heartbeat while processing
+    completed_at = Column(DateTime, nullable=True)
+    output_completed_at = Column(DateTime, nullable=True) # completion of the job that wrote processed_file_url, copied on cache hits
+    encoding_profile = Column(String, nullable=True) # preset, CRF and threads chosen for the job, see profiles
+    rendition_set = Column(JSON, nullable=True) # requested rendition names, eg ["720p_h264", "480p_h264"]
+
+    # Encode progress, updated by the worker every PROGRESS_UPDATE_INTERVAL seconds
+    progress_percent = Column(Float, nullable=True)
+    eta_seconds = Column(Float, nullable=True)
+    encode_speed = Column(Float, nullable=True) # media seconds encoded per second, ie realtime factor
+    progress_updated_at = Column(DateTime, nullable=True)
+
+    # Seconds spent in each worker stage, see timing.STAGES
+    queue_wait_seconds = Column(Float, nullable=True) # S3 event to claim
+    probe_seconds = Column(Float, nullable=True)
+    download_seconds = Column(Float, nullable=True)
+    encode_seconds = Column(Float, nullable=True)
+    upload_seconds = Column(Float, nullable=True)
+    finalize_seconds = Column(Float, nullable=True)
+
+    # Probed media metadata, set before the file is downloaded
+    duration = Column(Float, nullable=True) # seconds
+    width = Column(Integer, nullable=True)
+    height = Column(Integer, nullable=True)
+    bit_rate = Column(BigInteger, nullable=True) # bits/s
+    file_size = Column(BigInteger, nullable=True) # bytes
+    streams = Column(JSON, nullable=True) # [{index, codec_type, codec_name}]
     created_at = Column(DateTime, default=func.now())
 
+    # read only: renditions are written and deleted explicitly by crud
+    renditions = relationship(
+        "Renditions", primaryjoin="Files.file_id == foreign(Renditions.file_id)",
+        order_by="Renditions.height.desc()", viewonly=True,
+    )
+
+    @property
+    def has_poster(self) -> bool:
+        return self.poster_url is not None
+
+    @property
+    def has_sprite(self) -> bool:
+        return self.sprite_url is not None
+
+    __table_args__ = (
+        # keyset pagination of job listings on (created_at, file_id), with and without a status filter
+        Index("ix_files_created_at_file_id", "created_at", "file_id"),
+        Index("ix_files_status_created_at_file_id", "processing_status", "created_at", "file_id"),
+        # reaper scan for expired leases
+        Index("ix_files_status_lease_expires_at", "processing_status", "lease_expires_at"),
+    )
+
 class TransactionType(str, enum.Enum):
     UPLOAD = "upload"
     PENDING = "pending" # queued
@@ -34,10 +90,59 @@ class TransactionType(str, enum.Enum):
     COMPLETION = "completion"
     FAILURE = "failure"
 
+# Append-only audit log of every file state change, pruned and compacted by maintenance.py
 class Transactions(Base):
     __tablename__ = "transactions"
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
-    file_id = Column(UUID(as_uuid=True), index=True)
+    file_id = Column(UUID(as_uuid=True))
     type = Column(Enum(TransactionType))
     timestamp = Column(DateTime, default=func.now())
-    details = Column(String, nullable=True)
\ No newline at end of file
+    details = Column(String, nullable=True)
+
+    __table_args__ = (
+        # a file's history in timeline order, also serves plain file_id lookups
+        Index("ix_transactions_file_id_timestamp", "file_id", "timestamp"),
+        # retention scans by age: rows are appended in timestamp order, a BRIN index stays tiny and cheap to insert into
+        Index("ix_transactions_timestamp_brin", "timestamp", postgresql_using="brin"),
+    )
+
+# Extra outputs of a file's ABR ladder, see renditions.py
+class Renditions(Base):
+    __tablename__ = "renditions"
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    file_id = Column(UUID(as_uuid=True), index=True)
+    name = Column(String) # eg 720p_h264
+    codec = Column(Enum(Codec))
+    width = Column(Integer, nullable=True)
+    height = Column(Integer)
+    file_url = Column(String)
+    file_size = Column(BigInteger, nullable=True) # bytes
+    created_at = Column(DateTime, default=func.now())
+
+# Exponentially decayed regression sums of job processing time against media duration, per codec direction.
+# Updated by every completed transcode, fitted by cost_model.py
+class EncodeThroughput(Base):
+    __tablename__ = "encode_throughput"
+    original_codec = Column(Enum(Codec), primary_key=True)
+    target_codec = Column(Enum(Codec), primary_key=True)
+    weight = Column(Float, default=0.0) # decayed job count
+    sum_duration = Column(Float, default=0.0)
+    sum_time = Column(Float, default=0.0)
+    sum_duration_sq = Column(Float, default=0.0)
+    sum_duration_time = Column(Float, default=0.0)
+    updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
+
+# Queue table of the postgres job queue backend, see queues.py
+class Jobs(Base):
+    __tablename__ = "jobs"
+    id = Column(BigInteger, primary_key=True, autoincrement=True) # claimed in order
+    body = Column(String) # S3 event JSON, as in an SQS message
+    visible_at = Column(DateTime, default=func.now()) # hidden until then once received
+    receipt = Column(UUID(as_uuid=True), nullable=True) # new on every receive, stale receipts can not delete
+    receive_count = Column(Integer, default=0)
+    created_at = Column(DateTime, default=func.now())
+
+    __table_args__ = (
+        Index("ix_jobs_visible_at_id", "visible_at", "id"),
+        Index("ix_jobs_receipt", "receipt"),
+    )
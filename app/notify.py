@@ -0,0 +1,104 @@
+import asyncio
+import json
+import os
+import select
+import threading
+import time
+from collections import defaultdict
+
+import psycopg2
+import psycopg2.extensions
+
+from .cache import TTLCache
+from .database import engine
+
+# Push-based status updates: a background thread LISTENs on the file_status channel (NOTIFY is sent by the
+# files_status_notify trigger, see db_init) and fans each notification out to the requests waiting on that file.
+# The same notifications invalidate the in-process status cache used by GET /upload/{file_id}/status.
+
+STATUS_CHANNEL = "file_status"
+
+class StatusNotifier:
+    def __init__(self):
+        self.connected = False
+        self.invalidations = 0 # bumped on every notification, see cache_status
+        self._loop = None
+        self._waiters = defaultdict(set) # file_id str -> set of asyncio.Queue
+        self._stopped = threading.Event()
+        # entries are dropped on NOTIFY, the TTL only bounds staleness if a notification is ever missed
+        self.status_cache = TTLCache(
+            maxsize=int(os.getenv("STATUS_CACHE_SIZE", "10000")),
+            ttl=float(os.getenv("STATUS_CACHE_TTL", "60")),
+        )
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        self._loop = loop
+        threading.Thread(target=self._listen_forever, name="status-listener", daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def subscribe(self, file_id) -> asyncio.Queue:
+        queue = asyncio.Queue()
+        self._waiters[str(file_id)].add(queue)
+        return queue
+
+    def unsubscribe(self, file_id, queue: asyncio.Queue):
+        waiters = self._waiters.get(str(file_id))
+        if waiters is not None:
+            waiters.discard(queue)
+            if not waiters:
+                del self._waiters[str(file_id)]
+
+    def _publish(self, file_id: str, status: str):
+        for queue in self._waiters.get(file_id, ()):
+            queue.put_nowait(status)
+
+    def _listen_forever(self):
+        if engine.dialect.name != "postgresql":
+            print("Status notifications need PostgreSQL LISTEN/NOTIFY, status waits will poll the database")
+            return
+        dsn = engine.url.set(drivername="postgresql").render_as_string(hide_password=False)
+        while not self._stopped.is_set():
+            try:
+                conn = psycopg2.connect(dsn)
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                conn.cursor().execute(f"LISTEN {STATUS_CHANNEL}")
+                # notifications may have been missed while disconnected
+                self.status_cache.clear()
+                self.connected = True
+                print(f"Listening for {STATUS_CHANNEL} notifications")
+                while not self._stopped.is_set():
+                    if select.select([conn], [], [], 5) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        payload = json.loads(conn.notifies.pop(0).payload)
+                        file_id = payload["file_id"]
+                        self.invalidations += 1
+                        self.status_cache.pop(file_id)
+                        self._loop.call_soon_threadsafe(self._publish, file_id, payload["processing_status"])
+                conn.close()
+            except Exception as e:
+                self.connected = False
+                print(f"Status listener disconnected: {e}. Reconnecting in 2 seconds...")
+                time.sleep(2)
+
+    def cache_status(self, file_id, status: dict, generation: int):
+        # Only cache a status read started at `generation` if no notification arrived since,
+        # otherwise the read may be older than the invalidation. Without a listener nothing invalidates the cache.
+        if self.connected and self.invalidations == generation:
+            self.status_cache.set(str(file_id), status)
+
+    async def wait_for_change(self, file_id, queue: asyncio.Queue, timeout: float) -> bool:
+        """Waits until a notification for file_id arrives on queue, or timeout. Returns True on a notification.
+        Without a listener connection, returns after a short interval so callers fall back to polling the DB."""
+        if not self.connected:
+            timeout = min(timeout, float(os.getenv("STATUS_POLL_FALLBACK_INTERVAL", "2")))
+        try:
+            await asyncio.wait_for(queue.get(), timeout=timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+status_notifier = StatusNotifier()
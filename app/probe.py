@@ -0,0 +1,112 @@
+import json
+import subprocess
+import tempfile
+
+from .models import Codec
+
+# Probe stage: reads only the MP4 header region of an S3 object with range GETs and runs ffprobe on it,
+# so codec, duration, resolution and stream layout are known before the full object is downloaded.
+
+def read_range(s3_client, bucket: str, key: str, start: int, end: int) -> bytes:
+    # end is inclusive, as in the HTTP Range header
+    response = s3_client.get_object(Bucket=bucket, Key=key, Range=f"bytes={start}-{end}")
+    return response["Body"].read()
+
+def _top_level_boxes(s3_client, bucket: str, key: str, object_size: int):
+    """Yields (box_type, offset, size) of the top-level MP4 boxes, one small range GET per box header."""
+    offset = 0
+    while offset + 8 <= object_size:
+        header = read_range(s3_client, bucket, key, offset, min(offset + 15, object_size - 1))
+        box_size = int.from_bytes(header[0:4], "big")
+        box_type = header[4:8]
+        if box_size == 1: # 64-bit largesize follows the type
+            box_size = int.from_bytes(header[8:16], "big")
+        elif box_size == 0: # box extends to end of file
+            box_size = object_size - offset
+        if box_size < 8:
+            return # not an ISO BMFF file
+        yield box_type, offset, box_size
+        offset += box_size
+
+def read_header(s3_client, bucket: str, key: str, object_size: int):
+    """Returns (header_bytes, faststart) where header_bytes is enough of the file for ffprobe, or (None, False).
+    faststart: moov is before mdat, the header is the file prefix and the file can be demuxed from a pipe.
+    moov at end: the header is ftyp + moov fetched from their offsets, skipping mdat."""
+    ftyp = None
+    seen_mdat = False
+    for box_type, offset, size in _top_level_boxes(s3_client, bucket, key, object_size):
+        if box_type == b"ftyp":
+            ftyp = (offset, size)
+        elif box_type == b"mdat":
+            seen_mdat = True
+        elif box_type == b"moov":
+            if not seen_mdat:
+                return read_range(s3_client, bucket, key, 0, offset + size - 1), True
+            moov = read_range(s3_client, bucket, key, offset, offset + size - 1)
+            if ftyp:
+                moov = read_range(s3_client, bucket, key, ftyp[0], ftyp[0] + ftyp[1] - 1) + moov
+            return moov, False
+    return None, False
+
+def ffprobe(input_path: str) -> dict:
+    command = [
+        "ffprobe", "-v", "error", "-show_format", "-show_streams", "-of", "json", "-i", input_path,
+    ]
+    try:
+        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=True)
+        return json.loads(result.stdout)
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f"ffprobe failed: {e.stderr}")
+
+def _ffprobe_bytes(data: bytes) -> dict:
+    with tempfile.NamedTemporaryFile(suffix=".mp4") as f:
+        f.write(data)
+        f.flush()
+        return ffprobe(f.name)
+
+def media_metadata(probe: dict, file_size: int) -> dict:
+    """Metadata stored on the File record from ffprobe output. Raises RuntimeError for unsupported codecs."""
+    streams = probe.get("streams", [])
+    video = next((s for s in streams if s.get("codec_type") == "video"), None)
+    if video is None:
+        raise RuntimeError("No video stream detected")
+    try:
+        codec = Codec(video.get("codec_name"))
+    except ValueError:
+        raise RuntimeError(f"Unsupported codec detected: {video.get('codec_name')}")
+
+    duration = float(probe.get("format", {}).get("duration") or video.get("duration") or 0) or None
+    return {
+        "original_codec": codec,
+        "duration": duration,
+        "width": video.get("width"),
+        "height": video.get("height"),
+        # from the object size, the probed header alone has no media data
+        "bit_rate": int(file_size * 8 / duration) if duration else None,
+        "file_size": file_size,
+        "streams": [
+            {"index": s.get("index"), "codec_type": s.get("codec_type"), "codec_name": s.get("codec_name")}
+            for s in streams
+        ],
+    }
+
+def probe_s3_object(s3_client, bucket: str, key: str) -> dict:
+    """Probes s3://bucket/key without downloading it.
+    Returns the media metadata plus `faststart`, whether the object can be streamed through ffmpeg."""
+    file_size = s3_client.head_object(Bucket=bucket, Key=key)["ContentLength"]
+    header, faststart = read_header(s3_client, bucket, key, file_size)
+    probe = None
+    if header is not None:
+        try:
+            probe = _ffprobe_bytes(header)
+        except RuntimeError as e:
+            print(f"ffprobe of header failed, probing over HTTP: {e}")
+    if probe is None or not probe.get("streams"):
+        # Not an MP4 or an unusual layout: let ffprobe seek the object itself with HTTP range requests
+        url = s3_client.generate_presigned_url("get_object", Params={"Bucket": bucket, "Key": key}, ExpiresIn=600)
+        probe = ffprobe(url)
+
+    metadata = media_metadata(probe, file_size)
+    print(f"Probed s3://{bucket}/{key}: {metadata}")
+    metadata["faststart"] = faststart
+    return metadata
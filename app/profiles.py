@@ -0,0 +1,88 @@
+import os
+from dataclasses import dataclass, replace
+
+from .models import Codec
+
+# Encoding profiles: the worker picks preset, CRF and thread count per job from the queue depth, the job's
+# probed duration and a turnaround target, and the jobs already running on the host. Under load faster presets keep up with the backlog,
+# when the queue is idle slower, higher quality presets are used.
+
+# Fastest to slowest. Rough encode speed of each x264/x265 preset relative to `fast`
+PRESET_SPEED = {
+    "ultrafast": 6.0,
+    "superfast": 4.5,
+    "veryfast": 3.0,
+    "faster": 1.7,
+    "fast": 1.0,
+    "medium": 0.8,
+    "slow": 0.4,
+}
+# Faster presets compress worse at the same CRF, raise CRF to keep output size in check;
+# the idle-queue slow preset spends the extra time on quality instead
+PRESET_CRF_OFFSET = {"ultrafast": 3, "superfast": 2, "veryfast": 1, "slow": -1}
+BASE_CRF = {Codec.H264: 23, Codec.HEVC: 28}
+
+@dataclass(frozen=True)
+class EncodingProfile:
+    preset: str
+    crf: int
+    threads: int = 0 # 0 lets the encoder decide
+
+    @property
+    def name(self) -> str:
+        return f"preset={self.preset} crf={self.crf} threads={self.threads or 'auto'}"
+
+    def with_threads(self, threads: int) -> "EncodingProfile":
+        return replace(self, threads=threads)
+
+def default_profile(target_codec: Codec) -> EncodingProfile:
+    return EncodingProfile(preset="fast", crf=BASE_CRF[target_codec])
+
+def default_realtime_factor(target_codec: Codec) -> float:
+    # media seconds encoded per wall-clock second with the `fast` preset on this hardware
+    if target_codec == Codec.HEVC:
+        return float(os.getenv("ENCODE_REALTIME_FACTOR_HEVC", "0.25"))
+    return float(os.getenv("ENCODE_REALTIME_FACTOR_H264", "1.0"))
+
+def fleet_slots() -> int:
+    # concurrent jobs across all workers
+    return int(os.getenv("ENCODE_FLEET_SLOTS") or os.getenv("WORKER_CONCURRENCY") or os.cpu_count() or 1)
+
+def _encoder_threads() -> int:
+    # 0 (encoder auto) unless pinned
+    return int(os.getenv("ENCODE_THREADS") or 0)
+
+def encoder_threads(cost: float, running_costs: list) -> int:
+    """Threads for a job of `cost` (see scheduler.job_cost) starting while jobs of `running_costs` run on this host.
+    A job alone gets 0, every core to the encoder. Next to other jobs it gets a share of the cores in proportion
+    to its cost, so a short clip doesn't take cores from a long encode. ENCODE_THREADS pins the count."""
+    if os.getenv("ENCODE_THREADS") or not running_costs:
+        return _encoder_threads()
+    cores = os.cpu_count() or 1
+    total = cost + sum(running_costs)
+    share = cost / total if total > 0 else 1 / (len(running_costs) + 1)
+    return max(round(cores * share), 1)
+
+def select_profile(target_codec: Codec, duration: float, queue_depth: int, realtime_factor: float = None,
+                   threads: int = None) -> EncodingProfile:
+    """Slowest (best quality) preset whose estimated encode time fits this job's share of the turnaround target.
+    With `queue_depth` jobs waiting over `ENCODE_FLEET_SLOTS` slots, each job gets 1 / (1 + depth / slots) of the target.
+    threads: see encoder_threads, ENCODE_THREADS or encoder auto if None."""
+    if threads is None:
+        threads = _encoder_threads()
+    if not os.getenv("ENCODE_TURNAROUND_TARGET") or not duration:
+        return default_profile(target_codec).with_threads(threads)
+
+    target = float(os.getenv("ENCODE_TURNAROUND_TARGET"))
+    budget = target / (1 + queue_depth / fleet_slots())
+    base_seconds = duration / (realtime_factor or default_realtime_factor(target_codec)) # at `fast`
+
+    presets = list(PRESET_SPEED)
+    slowest_allowed = os.getenv("ENCODE_MAX_QUALITY_PRESET", "medium")
+    candidates = presets[:presets.index(slowest_allowed) + 1]
+    preset = candidates[0] # fastest if nothing fits the budget
+    for candidate in candidates:
+        if base_seconds / PRESET_SPEED[candidate] <= budget:
+            preset = candidate
+    crf = BASE_CRF[target_codec] + PRESET_CRF_OFFSET.get(preset, 0)
+    return EncodingProfile(preset=preset, crf=crf, threads=threads)
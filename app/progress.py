@@ -0,0 +1,50 @@
+import os
+import threading
+import time
+from uuid import UUID
+from sqlalchemy.orm import Session
+
+from . import crud
+
+class ProgressTracker:
+    """Joins ffmpeg progress (encoded media time) with the probed duration of a job.
+    Percent complete, ETA and the encode speed (media seconds per wall-clock second) are written to the
+    File record at most every PROGRESS_UPDATE_INTERVAL seconds, not on every ffmpeg progress line.
+    Several ffmpeg processes (segmented mode) can report under their own key, their media times are summed."""
+
+    def __init__(self, db: Session, file_id: UUID, duration: float):
+        self.db = db
+        self.file_id = file_id
+        self.duration = duration
+        self.interval = float(os.getenv("PROGRESS_UPDATE_INTERVAL", "5"))
+        self.started_at = None # first progress report, so download time does not count against encode speed
+        self._last_persisted = 0.0
+        self._out_times = {} # key -> encoded seconds
+        self._lock = threading.Lock() # segment encodes report from several threads, sharing one DB session
+
+    def callback(self, key: str = ""):
+        # on_progress callback for ffmpeg_popen
+        def on_progress(out_time: float, fps: float, speed: float):
+            self.update(key, out_time, fps, speed)
+        return on_progress
+
+    def update(self, key: str, out_time: float, fps: float = None, speed: float = None):
+        if not self.duration:
+            return # nothing to measure against
+        with self._lock:
+            self._out_times[key] = out_time
+            now = time.monotonic()
+            if self.started_at is None:
+                self.started_at = now
+            if now - self._last_persisted < self.interval:
+                return
+            self._last_persisted = now
+
+            done = min(sum(self._out_times.values()), self.duration)
+            elapsed = now - self.started_at
+            encode_speed = done / elapsed if elapsed > 0 else None
+            eta_seconds = (self.duration - done) / encode_speed if encode_speed else None
+            percent = 100.0 * done / self.duration
+            eta = f"{eta_seconds:.0f}s" if eta_seconds is not None else "unknown"
+            print(f"[progress] {self.file_id} {percent:.1f}% fps={fps} speed={speed}x eta={eta}")
+            crud.update_file_progress(self.db, self.file_id, percent, eta_seconds, encode_speed)
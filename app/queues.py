@@ -0,0 +1,206 @@
+import json
+import os
+import select
+import threading
+import time
+from uuid import UUID
+from datetime import datetime, timedelta, timezone
+
+import psycopg2
+import psycopg2.extensions
+from sqlalchemy import delete, func, insert, select as sql_select, update
+
+from . import models
+from .clients import get_sqs_client
+from .database import SessionLocal, engine
+
+# Job queue under the worker, JOB_QUEUE_BACKEND selects the implementation:
+# - sqs (default): S3 event notifications of the raw bucket, delivered to SQS_QUEUE_URL
+# - postgres: the jobs table of the app database. The api enqueues as soon as an upload is complete, workers claim
+#   jobs with UPDATE ... WHERE id IN (SELECT ... FOR UPDATE SKIP LOCKED) and are woken by NOTIFY from the
+#   jobs_notify trigger (see db_init), so a job starts within milliseconds and no AWS queue is needed.
+# Both hand out SQS-shaped messages, {"MessageId", "ReceiptHandle", "Body"} with an S3 event as Body, with the same
+# visibility semantics: a received message is hidden until it is deleted or its visibility timeout passes.
+
+JOB_CHANNEL = "job_queue"
+
+def queue_backend() -> str:
+    return os.getenv("JOB_QUEUE_BACKEND", "sqs").lower()
+
+def visibility_timeout() -> int:
+    # seconds a received message stays hidden, the SQS queue's setting is overridden by every heartbeat
+    return int(os.getenv("SQS_VISIBILITY_TIMEOUT", "300"))
+
+def s3_event_body(bucket: str, key: str) -> dict:
+    # the event S3 sends when an object is created, as much of it as the worker reads
+    return {"Records": [{
+        "eventTime": datetime.now(timezone.utc).isoformat().replace("+00:00", "Z"),
+        "s3": {"bucket": {"name": bucket}, "object": {"key": key}},
+    }]}
+
+class SQSQueue:
+    enqueues_on_upload = False # the raw bucket's event notifications enqueue
+
+    def __init__(self):
+        self.client = get_sqs_client()
+        self.queue_url = os.getenv("SQS_QUEUE_URL")
+
+    def receive(self, max_messages: int, wait_seconds: int) -> list:
+        response = self.client.receive_message(
+            QueueUrl=self.queue_url, MaxNumberOfMessages=min(max_messages, 10), WaitTimeSeconds=wait_seconds
+        )
+        return response.get("Messages", [])
+
+    def delete(self, message: dict):
+        self.client.delete_message(QueueUrl=self.queue_url, ReceiptHandle=message["ReceiptHandle"])
+
+    def extend_visibility(self, messages: list, timeout: int) -> list:
+        """Hides messages for another `timeout` seconds. Returns the failures as strings."""
+        failures = []
+        for start in range(0, len(messages), 10): # SQS batch limit
+            entries = [
+                {"Id": str(i), "ReceiptHandle": message["ReceiptHandle"], "VisibilityTimeout": timeout}
+                for i, message in enumerate(messages[start:start + 10])
+            ]
+            response = self.client.change_message_visibility_batch(QueueUrl=self.queue_url, Entries=entries)
+            failures += [f"{failure.get('Code')} {failure.get('Message')}" for failure in response.get("Failed", [])]
+        return failures
+
+    def send(self, body: dict):
+        self.client.send_message(QueueUrl=self.queue_url, MessageBody=json.dumps(body))
+
+    def send_batch(self, bodies: list):
+        for start in range(0, len(bodies), 10): # SQS batch limit
+            entries = [{"Id": str(i), "MessageBody": json.dumps(body)} for i, body in enumerate(bodies[start:start + 10])]
+            response = self.client.send_message_batch(QueueUrl=self.queue_url, Entries=entries)
+            if response.get("Failed"):
+                raise RuntimeError(f"Failed to queue {len(response['Failed'])} messages: {response['Failed'][0].get('Message')}")
+
+    def depth(self) -> int:
+        attributes = self.client.get_queue_attributes(
+            QueueUrl=self.queue_url, AttributeNames=["ApproximateNumberOfMessages"]
+        )["Attributes"]
+        return int(attributes["ApproximateNumberOfMessages"])
+
+class PostgresQueue:
+    enqueues_on_upload = True
+
+    def __init__(self):
+        self._listener = None # LISTEN connection, opened by the first receive that has to wait
+        self._lock = threading.Lock()
+
+    def _claim(self, max_messages: int) -> list:
+        available = (
+            sql_select(models.Jobs.id)
+            .where(models.Jobs.visible_at <= func.now())
+            .order_by(models.Jobs.id)
+            .limit(max_messages)
+            .with_for_update(skip_locked=True)
+        )
+        db = SessionLocal()
+        try:
+            rows = db.execute(
+                update(models.Jobs)
+                .where(models.Jobs.id.in_(available.scalar_subquery()))
+                .values(
+                    visible_at=func.now() + timedelta(seconds=visibility_timeout()),
+                    receipt=func.gen_random_uuid(),
+                    receive_count=models.Jobs.receive_count + 1,
+                )
+                .returning(models.Jobs.id, models.Jobs.body, models.Jobs.receipt)
+            ).all()
+            db.commit()
+        finally:
+            db.close()
+        return [{"MessageId": str(job_id), "ReceiptHandle": str(receipt), "Body": body} for job_id, body, receipt in sorted(rows)]
+
+    def _wait_for_notify(self, timeout: float):
+        with self._lock:
+            if self._listener is None:
+                dsn = engine.url.set(drivername="postgresql").render_as_string(hide_password=False)
+                self._listener = psycopg2.connect(dsn)
+                self._listener.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                self._listener.cursor().execute(f"LISTEN {JOB_CHANNEL}")
+            listener = self._listener
+        try:
+            if select.select([listener], [], [], timeout) != ([], [], []):
+                listener.poll()
+                listener.notifies.clear()
+        except (psycopg2.Error, OSError) as e:
+            print(f"Job queue listener disconnected: {e}")
+            listener.close()
+            with self._lock:
+                self._listener = None
+
+    def receive(self, max_messages: int, wait_seconds: int) -> list:
+        # Waits up to wait_seconds for a job like an SQS long poll. NOTIFY only signals new jobs, jobs whose
+        # visibility expired are picked up by the claim at the end of the wait
+        deadline = time.monotonic() + wait_seconds
+        while True:
+            messages = self._claim(max_messages)
+            remaining = deadline - time.monotonic()
+            if messages or remaining <= 0:
+                return messages
+            self._wait_for_notify(remaining)
+
+    def delete(self, message: dict):
+        # a stale receipt (the job was redelivered to another worker) deletes nothing
+        db = SessionLocal()
+        try:
+            db.execute(delete(models.Jobs).where(models.Jobs.receipt == UUID(message["ReceiptHandle"])))
+            db.commit()
+        finally:
+            db.close()
+
+    def extend_visibility(self, messages: list, timeout: int) -> list:
+        handles = [message["ReceiptHandle"] for message in messages]
+        if not handles:
+            return []
+        db = SessionLocal()
+        try:
+            extended = db.scalars(
+                update(models.Jobs)
+                .where(models.Jobs.receipt.in_([UUID(handle) for handle in handles]))
+                .values(visible_at=func.now() + timedelta(seconds=timeout))
+                .returning(models.Jobs.receipt)
+            ).all()
+            db.commit()
+        finally:
+            db.close()
+        extended = {str(receipt) for receipt in extended}
+        return [f"ReceiptHandleIsInvalid {handle}" for handle in handles if handle not in extended]
+
+    def send(self, body: dict):
+        self.send_batch([body])
+
+    def send_batch(self, bodies: list):
+        db = SessionLocal()
+        try:
+            self.add_jobs(db, bodies)
+            db.commit()
+        finally:
+            db.close()
+
+    def add_jobs(self, db, bodies: list):
+        """Inserts jobs in the caller's transaction, not committed: the api enqueues in the same commit as the
+        PENDING transition, so a file is never left PENDING without a job. One insert statement, so one NOTIFY."""
+        if bodies:
+            db.execute(insert(models.Jobs), [{"body": json.dumps(body)} for body in bodies])
+
+    def depth(self) -> int:
+        db = SessionLocal()
+        try:
+            return db.scalar(sql_select(func.count()).select_from(models.Jobs).where(models.Jobs.visible_at <= func.now()))
+        finally:
+            db.close()
+
+_queues = {}
+
+def get_job_queue():
+    # one per process, like the boto3 clients: the LISTEN connection must not be shared with forked processes
+    key = os.getpid()
+    queue = _queues.get(key)
+    if queue is None:
+        queue = PostgresQueue() if queue_backend() == "postgres" else SQSQueue()
+        _queues[key] = queue
+    return queue
@@ -0,0 +1,55 @@
+import os
+import re
+
+from .models import Codec
+from .ffmpeg import ffmpeg_popen, video_encoder_args, container_args
+
+# ABR rendition ladder: extra lower resolution outputs of a job, named "<height>p_<codec>[@<kbps>k]",
+# eg 720p_h264, 480p_hevc@800k. The source is decoded once and split to one encoder per output
+# in a single ffmpeg filter graph, instead of decoding it again for every rendition.
+
+_RENDITION_NAME = re.compile(r"^(\d{3,4})p_(h264|hevc)(?:@(\d+)k)?$")
+MAX_RENDITIONS = 8
+
+def parse_rendition_set(names) -> list:
+    """Validates rendition names, from a comma-separated string or a list. Raises ValueError."""
+    if isinstance(names, str):
+        names = names.split(",")
+    names = list(dict.fromkeys(name.strip().lower() for name in names if name.strip()))
+    for name in names:
+        if not _RENDITION_NAME.match(name):
+            raise ValueError(f"Invalid rendition '{name}', expected <height>p_<h264|hevc>[@<kbps>k] eg 720p_h264")
+    if len(names) > MAX_RENDITIONS:
+        raise ValueError(f"At most {MAX_RENDITIONS} renditions per file")
+    return names
+
+def rendition_spec(name: str) -> dict:
+    height, codec, max_kbps = _RENDITION_NAME.match(name).groups()
+    return {"name": name, "height": int(height), "codec": Codec(codec), "max_kbps": int(max_kbps) if max_kbps else None}
+
+def rendition_key(s3_key: str, name: str) -> str:
+    key_without_ext, _ = os.path.splitext(s3_key)
+    return f"{key_without_ext}_{name}.mp4"
+
+def transcode_outputs(input_path: str, outputs: list, on_progress=None):
+    """Encodes every output from one decode of input_path.
+    outputs: dicts with path, codec, profile, and height / max_kbps (None keeps the source resolution / rate control)
+    and faststart."""
+    labels = [f"[v{i}]" for i in range(len(outputs))]
+    filters = [f"[0:v:0]split={len(outputs)}{''.join(labels)}"]
+    command_outputs = []
+    for i, output in enumerate(outputs):
+        label = labels[i]
+        if output.get("height"):
+            filters.append(f"{label}scale=-2:{output['height']}[s{i}]") # -2 keeps the width even
+            label = f"[s{i}]"
+        rate_control = []
+        if output.get("max_kbps"):
+            rate_control = ["-maxrate", f"{output['max_kbps']}k", "-bufsize", f"{output['max_kbps'] * 2}k"]
+        command_outputs += [
+            "-map", label, "-map", "0:a?", *video_encoder_args(output["codec"], output.get("profile")), *rate_control,
+            "-c:a", "copy", *container_args(output.get("faststart", False)), output["path"],
+        ]
+    print(f"Encoding {len(outputs)} outputs from a single decode")
+    command = ["ffmpeg", "-i", input_path, "-filter_complex", ";".join(filters), *command_outputs]
+    ffmpeg_popen(command, on_progress)
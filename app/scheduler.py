@@ -0,0 +1,115 @@
+import os
+import json
+import time
+from uuid import UUID
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+from . import crud
+from .database import SessionLocal
+from .probe import probe_s3_object
+
+# Size-aware job scheduling for the worker: received messages are probed and buffered locally, then started
+# shortest expected job first, so short clips don't queue behind long encodes.
+# Some job slots are reserved for small jobs, and a job buffered longer than SCHEDULER_MAX_WAIT
+# goes ahead of shorter ones so large jobs are never starved.
+
+REFERENCE_PIXELS = 1920 * 1080
+
+# s3 keys are original_filename-uuid.ext
+def file_id_from_key(s3_key: str) -> UUID:
+    key_without_ext, _ = os.path.splitext(s3_key)
+    return UUID(key_without_ext[-36:])
+
+@dataclass
+class Job:
+    message: dict
+    s3_key: str = None
+    metadata: dict = None # probe_s3_object output, passed on to the job so it isn't probed twice
+    cost: float = 0.0 # media seconds at 1080p, ie duration scaled by resolution
+    received_at: float = field(default_factory=time.monotonic)
+
+    @property
+    def file_id(self):
+        try:
+            return file_id_from_key(self.s3_key) if self.s3_key else None
+        except ValueError:
+            return None
+
+    @property
+    def large(self) -> bool:
+        return self.cost > float(os.getenv("SMALL_JOB_MAX_COST", "60"))
+
+def job_cost(metadata: dict) -> float:
+    duration = metadata.get("duration") or 0.0
+    pixels = (metadata.get("width") or 0) * (metadata.get("height") or 0) or REFERENCE_PIXELS
+    return duration * pixels / REFERENCE_PIXELS
+
+def _probe_job(job: Job, s3_client, raw_bucket: str):
+    try:
+        job.s3_key = json.loads(job.message["Body"])["Records"][0]["s3"]["object"]["key"]
+        start = time.perf_counter()
+        job.metadata = probe_s3_object(s3_client, raw_bucket, job.s3_key)
+        job.metadata["probe_seconds"] = time.perf_counter() - start
+        job.cost = job_cost(job.metadata)
+    except Exception as e:
+        # Unparseable or unprobeable: schedule as a small job, it fails fast and records the error itself
+        print(f"Could not probe message {job.message.get('MessageId')} for scheduling: {e}")
+        job.metadata = None
+
+def _save_probe_results(jobs: list):
+    # pending rows get their codec and duration now rather than when claimed, for the api's completion predictions
+    results = {job.file_id: job.metadata for job in jobs if job.metadata and job.file_id}
+    if not results:
+        return
+    db = SessionLocal()
+    try:
+        crud.save_probe_results(db, results)
+    except Exception as e:
+        print(f"Could not save probe results of {len(results)} buffered jobs: {e}")
+    finally:
+        db.close()
+
+class JobScheduler:
+    def __init__(self, concurrency: int):
+        self.concurrency = concurrency
+        # at least one slot must stay usable by large jobs
+        self.reserved_small_slots = min(int(os.getenv("SMALL_JOB_RESERVED_SLOTS", "1")), concurrency - 1)
+        self.max_wait = float(os.getenv("SCHEDULER_MAX_WAIT", "300"))
+        # Buffered messages are invisible on the queue to other workers, keep the buffer small
+        self.buffer_size = int(os.getenv("SCHEDULER_BUFFER_SIZE", "10"))
+        self.buffer = []
+
+    def free_buffer(self, idle_slots: int = 0) -> int:
+        """Messages to receive. idle_slots are free slots no buffered job may start in, eg reserved small slots
+        with only large jobs buffered: up to that many are received past a full buffer (at most twice buffer_size)
+        so a small job can fill them."""
+        room = self.buffer_size - len(self.buffer)
+        if idle_slots > 0:
+            room = max(room, min(idle_slots, 2 * self.buffer_size - len(self.buffer)))
+        return max(room, 0)
+
+    def add(self, messages: list, s3_client, raw_bucket: str):
+        jobs = [Job(message) for message in messages]
+        # probes are a few range GETs and an ffprobe each, run them side by side
+        with ThreadPoolExecutor(max_workers=max(len(jobs), 1)) as executor:
+            list(executor.map(lambda job: _probe_job(job, s3_client, raw_bucket), jobs))
+        _save_probe_results(jobs)
+        self.buffer.extend(jobs)
+
+    def _priority(self, job: Job, now: float):
+        waited = now - job.received_at
+        if waited >= self.max_wait:
+            return (0, -waited) # overdue, oldest first
+        return (1, job.cost)
+
+    def pop(self, running_large: int):
+        """Next job to start given the number of large jobs running, or None if nothing may start now."""
+        large_allowed = running_large < self.concurrency - self.reserved_small_slots
+        candidates = [job for job in self.buffer if large_allowed or not job.large]
+        if not candidates:
+            return None
+        now = time.monotonic()
+        job = min(candidates, key=lambda job: self._priority(job, now))
+        self.buffer.remove(job)
+        return job
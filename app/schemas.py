@@ -1,7 +1,9 @@
 from pydantic import BaseModel
 from uuid import UUID
-from .models import ProcessingStatus, Codec
-from typing import Optional
+from datetime import datetime
+from .models import ProcessingStatus, Codec, TransactionType
+from typing import Optional, List
+from pydantic import Field
 
 class UploadResponse(BaseModel):
     file_id: UUID
@@ -11,6 +13,16 @@ class UploadResponse(BaseModel):
     class Config:
         from_attributes = True
 
+class RenditionResponse(BaseModel):
+    name: str
+    codec: Codec
+    width: Optional[int] = None
+    height: int
+    file_size: Optional[int] = None
+
+    class Config:
+        from_attributes = True
+
 class StatusResponse(BaseModel):
     file_id: UUID
     file_name: str
@@ -18,10 +30,125 @@ class StatusResponse(BaseModel):
 
     original_codec: Optional[Codec] = None
     target_codec: Optional[Codec] = None
+    faststart: Optional[bool] = None
     processing_time: Optional[float] = None
+    created_at: Optional[datetime] = None
+    processing_started_at: Optional[datetime] = None
+    predicted_completion_at: Optional[datetime] = None # from the historical cost model, while pending or processing
+    encoding_profile: Optional[str] = None
+    rendition_set: Optional[List[str]] = None # requested
+    renditions: List[RenditionResponse] = [] # completed
+    has_poster: bool = False # download from /upload/{file_id}/download/poster
+    has_sprite: bool = False # and /upload/{file_id}/download/sprite
+
+    duration: Optional[float] = None
+    width: Optional[int] = None
+    height: Optional[int] = None
+    bit_rate: Optional[int] = None
+    file_size: Optional[int] = None
+
+    progress_percent: Optional[float] = None
+    eta_seconds: Optional[float] = None
+    encode_speed: Optional[float] = None
+    progress_updated_at: Optional[datetime] = None
+
+    queue_wait_seconds: Optional[float] = None
+    probe_seconds: Optional[float] = None
+    download_seconds: Optional[float] = None
+    encode_seconds: Optional[float] = None
+    upload_seconds: Optional[float] = None
+    finalize_seconds: Optional[float] = None
 
     class Config:
         from_attributes = True
 
 class DownloadURLResponse(BaseModel):
     download_url: str
+
+
+class MultipartUploadRequest(BaseModel):
+    file_name: str
+    file_size: int = Field(gt=0) # bytes, sizes the presigned parts
+    renditions: Optional[List[str]] = None # ABR ladder, eg ["720p_h264", "480p_h264"]
+    target_codec: Optional[Codec] = None # default: the opposite of the uploaded codec
+    faststart: bool = False
+
+class BatchUploadResult(BaseModel):
+    file_name: str
+    file_id: Optional[UUID] = None # None for skipped archive members
+    processing_status: Optional[ProcessingStatus] = None
+    error: Optional[str] = None
+
+class BatchUploadResponse(BaseModel):
+    results: List[BatchUploadResult] # in request order, archive members in archive order
+
+class PresignedPart(BaseModel):
+    part_number: int
+    upload_url: str
+
+class MultipartUploadResponse(BaseModel):
+    file_id: UUID
+    s3_key: str
+    upload_id: str
+    part_size: int
+    parts: List[PresignedPart]
+
+class CompletedPart(BaseModel):
+    part_number: int
+    etag: str
+
+class CompleteMultipartUploadRequest(BaseModel):
+    upload_id: str
+    parts: List[CompletedPart]
+
+class AbortMultipartUploadRequest(BaseModel):
+    upload_id: str
+
+
+class BatchStatusRequest(BaseModel):
+    file_ids: List[UUID] = Field(min_length=1, max_length=1000)
+
+class BatchStatusResponse(BaseModel):
+    statuses: List[StatusResponse]
+    not_found: List[UUID]
+
+class FileListItem(StatusResponse):
+    created_at: datetime
+
+class FileListResponse(BaseModel):
+    items: List[FileListItem]
+    next_cursor: Optional[str] = None # pass as `cursor` to get the next page
+
+class TransactionResponse(BaseModel):
+    type: TransactionType
+    timestamp: datetime
+    details: Optional[str] = None
+
+    class Config:
+        from_attributes = True
+
+class FileHistoryResponse(BaseModel):
+    file_id: UUID
+    events: List[TransactionResponse] # oldest first
+
+class ThroughputFitResponse(BaseModel):
+    original_codec: Codec
+    target_codec: Codec
+    samples: float # decayed job count
+    mean_seconds: float
+    overhead_seconds: float
+    seconds_per_media_second: float
+
+    class Config:
+        from_attributes = True
+
+class BacklogResponse(BaseModel):
+    pending_jobs: int
+    processing_jobs: int
+    pending_work_seconds: float
+    processing_remaining_seconds: float
+    fleet_slots: int
+    drain_seconds: float
+    drain_completed_at: datetime
+    slots_needed: Optional[int] = None # to drain within target_seconds
+    throughput: List[ThroughputFitResponse]
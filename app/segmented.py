@@ -0,0 +1,72 @@
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from .models import Codec
+from .ffmpeg import ffmpeg_popen, video_encoder_args, container_args
+from .profiles import EncodingProfile
+
+# Segmented transcoding for long inputs:
+# split the video stream at keyframes, encode segments in parallel, then stitch them back together
+# with the original audio stream-copied from the source.
+
+MB = 1024 * 1024
+
+def should_segment(file_size: int, duration: float) -> bool:
+    # Thresholds of 0 disable that check; both 0 disables segmented mode
+    min_duration = float(os.getenv("SEGMENT_MIN_DURATION", "300")) # seconds
+    min_bytes = int(os.getenv("SEGMENT_MIN_SIZE_MB", "500")) * MB
+    if min_bytes and file_size >= min_bytes:
+        return True
+    if min_duration and duration and duration >= min_duration:
+        return True
+    return False
+
+def split_at_keyframes(input_path: str, work_dir: str) -> list:
+    segment_seconds = os.getenv("SEGMENT_SECONDS", "60")
+    # -c copy makes the segment muxer cut on the first keyframe after each segment_time
+    command = [
+        "ffmpeg", "-i", input_path, "-map", "0:v:0", "-c", "copy",
+        "-f", "segment", "-segment_time", segment_seconds, "-reset_timestamps", "1",
+        os.path.join(work_dir, "segment_%05d.mp4"),
+    ]
+    ffmpeg_popen(command)
+    return sorted(
+        os.path.join(work_dir, name) for name in os.listdir(work_dir) if name.startswith("segment_")
+    )
+
+def encode_segment(segment_path: str, target_codec: Codec, progress=None, profile: EncodingProfile = None) -> str:
+    output_path = segment_path.replace("segment_", "encoded_")
+    command = ["ffmpeg", "-i", segment_path, *video_encoder_args(target_codec, profile), "-an", output_path]
+    ffmpeg_popen(command, progress.callback(segment_path) if progress else None)
+    return output_path
+
+def concat_segments(encoded_paths: list, input_path: str, output_path: str, work_dir: str, faststart: bool = False):
+    list_path = os.path.join(work_dir, "segments.txt")
+    with open(list_path, "w") as f:
+        for path in encoded_paths:
+            f.write(f"file '{path}'\n")
+    # Video from the encoded segments, audio (if any) stream-copied from the original input
+    command = [
+        "ffmpeg", "-f", "concat", "-safe", "0", "-i", list_path, "-i", input_path,
+        "-map", "0:v", "-map", "1:a?", "-c", "copy", *container_args(faststart), output_path,
+    ]
+    ffmpeg_popen(command)
+
+def transcode_segmented(input_path: str, output_path: str, target_codec: Codec, progress=None, profile: EncodingProfile = None, faststart: bool = False):
+    # progress: a ProgressTracker, segments report their encoded media time separately and it sums them
+    parallelism = int(os.getenv("SEGMENT_PARALLELISM") or os.cpu_count() or 1)
+    if profile and profile.threads:
+        # the job's threads are shared between its concurrently encoding segments
+        profile = profile.with_threads(max(profile.threads // parallelism, 1))
+    work_dir = tempfile.mkdtemp(prefix="segments-", dir=os.path.dirname(output_path))
+    try:
+        segments = split_at_keyframes(input_path, work_dir)
+        print(f"Encoding {len(segments)} segments to {target_codec.value} with parallelism {parallelism}")
+        # Each segment is its own ffmpeg process, threads only wait on them
+        with ThreadPoolExecutor(max_workers=parallelism) as executor:
+            encoded = list(executor.map(lambda path: encode_segment(path, target_codec, progress, profile), segments))
+        concat_segments(encoded, input_path, output_path, work_dir, faststart)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
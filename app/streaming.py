@@ -0,0 +1,134 @@
+import os
+import hashlib
+import subprocess
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .models import Codec
+from .ffmpeg import FFmpegProgress, progress_args, video_encoder_args
+from .probe import read_range
+from .profiles import EncodingProfile
+
+# Zero-staging transcoding: ranged S3 reads feed ffmpeg's stdin, and ffmpeg's fragmented MP4 output
+# is uploaded as S3 multipart parts as they fill. Download, encode and upload overlap, with no local files.
+
+MB = 1024 * 1024
+
+def streaming_enabled() -> bool:
+    return os.getenv("STREAMING_TRANSCODE", "false").lower() == "true"
+
+def _feed_stdin(s3_client, bucket: str, key: str, object_size: int, stdin, content_hash, errors: list):
+    chunk_size = int(os.getenv("STREAM_READ_CHUNK_MB", "8")) * MB
+    try:
+        for start in range(0, object_size, chunk_size):
+            end = min(start + chunk_size, object_size) - 1
+            data = read_range(s3_client, bucket, key, start, end)
+            content_hash.update(data)
+            stdin.write(data)
+    except BrokenPipeError:
+        pass # ffmpeg exited early, its return code reports the failure
+    except Exception as e:
+        errors.append(e)
+    finally:
+        try:
+            stdin.close()
+        except BrokenPipeError:
+            pass
+
+# stderr carries both -progress blocks and ffmpeg errors, as stdout is the video output
+def _read_stderr(stderr, progress: FFmpegProgress, tail: deque):
+    for raw_line in stderr:
+        line = raw_line.decode(errors="replace").strip()
+        if line and not progress.feed(line):
+            print(f"[ffmpeg] {line}")
+            tail.append(line)
+
+def _read_part(stream, part_size: int) -> bytes:
+    # pipe reads can return short, keep reading until the part is full or EOF
+    chunks, remaining = [], part_size
+    while remaining > 0:
+        chunk = stream.read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b"".join(chunks)
+
+def _upload_parts(s3_client, bucket: str, key: str, upload_id: str, stream) -> list:
+    part_size = max(int(os.getenv("STREAM_PART_SIZE_MB", "16")), 5) * MB # S3 minimum part size is 5MB
+    max_in_flight = int(os.getenv("STREAM_UPLOAD_CONCURRENCY", "4"))
+    slots = threading.BoundedSemaphore(max_in_flight) # bounds buffered parts held in memory
+
+    def upload_part(part_number: int, data: bytes) -> dict:
+        try:
+            response = s3_client.upload_part(
+                Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=part_number, Body=data
+            )
+            return {"PartNumber": part_number, "ETag": response["ETag"]}
+        finally:
+            slots.release()
+
+    futures = []
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        part_number = 1
+        while True:
+            data = _read_part(stream, part_size)
+            if not data and part_number > 1:
+                break
+            slots.acquire()
+            # stop at the first failed part instead of encoding the rest of the file for nothing
+            failed = next((future for future in futures if future.done() and future.exception()), None)
+            if failed is not None:
+                slots.release()
+                raise failed.exception()
+            futures.append(executor.submit(upload_part, part_number, data))
+            part_number += 1
+            if len(data) < part_size:
+                break
+    return [future.result() for future in futures]
+
+def transcode_streaming(s3_client, raw_bucket: str, processed_bucket: str, s3_key: str, target_codec: Codec, object_size: int, on_progress=None, profile: EncodingProfile = None) -> str:
+    """Transcodes s3://raw_bucket/s3_key into s3://processed_bucket/s3_key without staging to disk.
+    The input must have its moov atom before mdat (see probe.read_header). Returns the input's content hash."""
+    command = [
+        "ffmpeg", *progress_args("pipe:2"), "-i", "pipe:0", *video_encoder_args(target_codec, profile), "-c:a", "copy",
+        # fragmented MP4 can be written to a non-seekable pipe
+        "-movflags", "frag_keyframe+empty_moov+default_base_moof", "-f", "mp4", "pipe:1",
+    ]
+    print(f"Streaming transcode s3://{raw_bucket}/{s3_key} -> s3://{processed_bucket}/{s3_key}")
+    # the upload is created first, so a failure here leaves no ffmpeg process or threads behind
+    upload_id = s3_client.create_multipart_upload(Bucket=processed_bucket, Key=s3_key)["UploadId"]
+    process = None
+    try:
+        process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        feed_errors = []
+        content_hash = hashlib.sha256()
+        feeder = threading.Thread(
+            target=_feed_stdin, args=(s3_client, raw_bucket, s3_key, object_size, process.stdin, content_hash, feed_errors), daemon=True
+        )
+        stderr_tail = deque(maxlen=20)
+        stderr_logger = threading.Thread(target=_read_stderr, args=(process.stderr, FFmpegProgress(on_progress), stderr_tail), daemon=True)
+        feeder.start()
+        stderr_logger.start()
+
+        parts = _upload_parts(s3_client, processed_bucket, s3_key, upload_id, process.stdout)
+        process.wait()
+        feeder.join()
+        stderr_logger.join()
+        if feed_errors:
+            raise RuntimeError(f"S3 streaming download failed: {feed_errors[0]}") from feed_errors[0]
+        if process.returncode != 0:
+            errors = " | ".join(stderr_tail)
+            raise RuntimeError(f"FFmpeg streaming transcode failed with exit code {process.returncode}: {errors}")
+        s3_client.complete_multipart_upload(
+            Bucket=processed_bucket, Key=s3_key, UploadId=upload_id, MultipartUpload={"Parts": parts}
+        )
+    except Exception:
+        if process is not None:
+            # closes ffmpeg's pipes, which ends the feeder and stderr threads
+            process.kill()
+            process.wait()
+        s3_client.abort_multipart_upload(Bucket=processed_bucket, Key=s3_key, UploadId=upload_id)
+        raise
+    return content_hash.hexdigest()
@@ -0,0 +1,114 @@
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+
+from .ffmpeg import ffmpeg_popen
+from .metrics import observe_transfer
+
+# Poster frame and scrub sprite for each upload, built from keyframes only:
+# every image is one input seek (-ss before -i) to the keyframe at or before the position, decoding only that keyframe
+# (-skip_frame nokey), so the source is never fully decoded. -noaccurate_seek keeps that keyframe: an accurate seek
+# would discard every frame before the position, and with only keyframes decoded there may be none left. The source can be a local file or a presigned URL,
+# over HTTP each seek is a few range reads.
+# The worker reads the raw object through a presigned URL, so previews run alongside the transcode without waiting for its download.
+
+def previews_enabled() -> bool:
+    return os.getenv("PREVIEWS_ENABLED", "true").lower() == "true"
+
+def preview_key(s3_key: str, kind: str) -> str:
+    key_without_ext, _ = os.path.splitext(s3_key)
+    return f"{key_without_ext}_{kind}.jpg"
+
+def _extract_keyframe(source: str, at: float, output_path: str, width: int) -> bool:
+    """Returns whether an image was written: ffmpeg exits 0 without output when no frame follows the seek"""
+    command = [
+        "ffmpeg", "-y", "-skip_frame", "nokey", "-noaccurate_seek", "-ss", f"{at:.3f}", "-i", source,
+        "-an", "-frames:v", "1", "-vf", f"scale={width}:-2", "-q:v", "3", output_path,
+    ]
+    ffmpeg_popen(command)
+    return os.path.exists(output_path)
+
+def generate_previews(source: str, duration: float) -> dict:
+    """Writes poster.jpg and sprite.jpg to a new temp directory, returns {"poster": path, "sprite": path, "dir": dir}.
+    The sprite is a SPRITE_COLUMNS x SPRITE_ROWS grid of thumbnails evenly spaced over the duration, row by row."""
+    columns = int(os.getenv("SPRITE_COLUMNS", "5"))
+    rows = int(os.getenv("SPRITE_ROWS", "5"))
+    tiles = columns * rows
+    duration = duration or 0.0
+    work_dir = tempfile.mkdtemp(prefix="previews-", dir="/tmp")
+    try:
+        poster_path = os.path.join(work_dir, "poster.jpg")
+        # a little way in, the first frames are often black
+        poster_width = int(os.getenv("POSTER_WIDTH", "1280"))
+        if not _extract_keyframe(source, duration * float(os.getenv("POSTER_POSITION", "0.1")), poster_path, poster_width):
+            print("No keyframe at the poster position, using the first keyframe")
+            if not _extract_keyframe(source, 0.0, poster_path, poster_width):
+                raise RuntimeError("No keyframe could be extracted for the poster")
+
+        tile_width = int(os.getenv("SPRITE_TILE_WIDTH", "160"))
+        tile_paths = [os.path.join(work_dir, f"tile_{i:03d}.jpg") for i in range(tiles)]
+        with ThreadPoolExecutor(max_workers=int(os.getenv("PREVIEW_PARALLELISM", "4"))) as executor:
+            extracted = list(executor.map(
+                lambda i: _extract_keyframe(source, (i + 0.5) * duration / tiles, tile_paths[i], tile_width), range(tiles)
+            ))
+        if not any(extracted):
+            raise RuntimeError("No keyframe could be extracted for the sprite")
+        # the tile filter reads a gapless image sequence: a missing tile repeats the closest earlier one (or the first)
+        missing = [i for i, ok in enumerate(extracted) if not ok]
+        if missing:
+            print(f"No keyframe for sprite tiles {missing}, repeating neighbouring tiles")
+        for i in missing:
+            previous = next((j for j in range(i - 1, -1, -1) if extracted[j]), extracted.index(True))
+            shutil.copyfile(tile_paths[previous], tile_paths[i])
+        sprite_path = os.path.join(work_dir, "sprite.jpg")
+        command = [
+            "ffmpeg", "-y", "-i", os.path.join(work_dir, "tile_%03d.jpg"),
+            "-vf", f"tile={columns}x{rows}", "-frames:v", "1", "-q:v", "3", sprite_path,
+        ]
+        ffmpeg_popen(command)
+        if not os.path.exists(sprite_path):
+            raise RuntimeError("ffmpeg wrote no sprite image")
+        return {"poster": poster_path, "sprite": sprite_path, "dir": work_dir}
+    except Exception:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        raise
+
+def build_previews(s3_client, raw_bucket: str, processed_bucket: str, s3_key: str, duration: float) -> dict:
+    """Generates the poster and sprite of s3_key and uploads them next to the processed file.
+    Returns {"poster_url": ..., "sprite_url": ...}, or {} if previews are disabled or failed: they never fail the job."""
+    if not previews_enabled():
+        return {}
+    previews = None
+    try:
+        source = s3_client.generate_presigned_url(
+            'get_object', Params={'Bucket': raw_bucket, 'Key': s3_key}, ExpiresIn=3600
+        )
+        previews = generate_previews(source, duration)
+        urls = {}
+        start = time.perf_counter()
+        for kind in ("poster", "sprite"):
+            key = preview_key(s3_key, kind)
+            s3_client.upload_file(previews[kind], processed_bucket, key, ExtraArgs={"ContentType": "image/jpeg"})
+            urls[f"{kind}_url"] = f"s3://{processed_bucket}/{key}"
+        observe_transfer("upload", sum(os.path.getsize(previews[kind]) for kind in ("poster", "sprite")), time.perf_counter() - start)
+        return urls
+    except (RuntimeError, ClientError, OSError) as e:
+        print(f"Preview generation failed for {s3_key}, continuing without: {e}")
+        return {}
+    finally:
+        if previews:
+            shutil.rmtree(previews["dir"], ignore_errors=True)
+
+def delete_previews(s3_client, processed_bucket: str, s3_key: str, urls: dict):
+    """Deletes the preview objects build_previews uploaded for s3_key, urls is what it returned."""
+    for kind in ("poster", "sprite"):
+        if f"{kind}_url" not in urls:
+            continue
+        try:
+            s3_client.delete_object(Bucket=processed_bucket, Key=preview_key(s3_key, kind))
+        except ClientError as e:
+            print(f"Failed to delete {kind} of {s3_key}: {e}")
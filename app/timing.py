@@ -0,0 +1,26 @@
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from .metrics import JOB_STAGE_SECONDS
+
+# Per-stage job timings, stored on the File record as <stage>_seconds columns.
+# In streaming mode download, encode and upload overlap and are all recorded as encode.
+STAGES = ("queue_wait", "probe", "download", "encode", "upload", "finalize")
+
+def record(timings: dict, stage: str, seconds: float):
+    timings[stage] = timings.get(stage, 0.0) + seconds
+    JOB_STAGE_SECONDS.labels(stage).observe(seconds)
+
+@contextmanager
+def timed(timings: dict, stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(timings, stage, time.perf_counter() - start)
+
+def seconds_since(event_time: str) -> float:
+    # S3 event notifications carry an ISO 8601 UTC eventTime, eg 2025-06-12T12:35:00.123Z
+    start = datetime.fromisoformat(event_time.replace("Z", "+00:00"))
+    return max((datetime.now(timezone.utc) - start).total_seconds(), 0.0)
@@ -1,183 +1,382 @@
-import boto3
 from botocore.exceptions import ClientError
 import os
-import subprocess
+import hashlib
 import time
 import json
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 from uuid import UUID
 from sqlalchemy.orm import Session
 
-from . import crud, models
+from . import crud
 from .models import Codec
-from .database import SessionLocal
+from .database import SessionLocal, engine
+from .clients import get_s3_client
+from .queues import get_job_queue
+from .ffmpeg import transcode_to_h264, transcode_to_h265, remux
+from .segmented import should_segment, transcode_segmented
+from .streaming import streaming_enabled, transcode_streaming
+from .probe import probe_s3_object
+from .progress import ProgressTracker
+from .scheduler import JobScheduler, file_id_from_key
+from .lease import LeaseKeeper, WORKER_ID, lease_seconds
+from .renditions import rendition_spec, rendition_key, transcode_outputs
+from .thumbnails import build_previews, delete_previews
+from .timing import timed, record, seconds_since
+from .metrics import start_metrics_server, observe_transfer, ENCODE_REALTIME_FACTOR
+from .profiles import EncodingProfile, select_profile, encoder_threads
+from .cache import TTLCache
 
-# Main loop to poll SQS queue and process messages
+# Number of jobs transcoded concurrently by this worker container
+def _worker_concurrency() -> int:
+    return int(os.getenv("WORKER_CONCURRENCY") or os.cpu_count() or 1)
+
+# Approximate number of messages waiting on the queue, drives the encoding profile choice.
+# Cached briefly so a burst of jobs doesn't query the queue for each one
+_queue_depth_cache = TTLCache(maxsize=1, ttl=float(os.getenv("QUEUE_DEPTH_CACHE_TTL", "15")))
+
+def _queue_depth() -> int:
+    depth = _queue_depth_cache.get("depth")
+    if depth is None:
+        try:
+            depth = get_job_queue().depth()
+        except Exception as e:
+            print(f"Could not read queue depth, assuming an idle queue: {e}")
+            depth = 0
+        _queue_depth_cache.set("depth", depth)
+    return depth
+
+# Runs once in every pool process: drop DB connections inherited from the parent on fork
+def _init_job_process():
+    engine.dispose(close=False)
+
+# Main loop to poll the job queue (SQS or postgres, see queues.py) and process messages
+# Messages are received in batches, probed and buffered by the scheduler, and handed to a bounded pool of job processes
+# shortest job first. Polling continues while encodes run, and each message is deleted only once its own job finishes.
 def process_messages():
-    sqs_endpoint_url = os.getenv("SQS_ENDPOINT_URL") or None
-    sqs_client = boto3.client("sqs", endpoint_url=sqs_endpoint_url, region_name=os.getenv("AWS_REGION"))
-    queue_url = os.getenv("SQS_QUEUE_URL")
+    queue = get_job_queue()
+    s3_client = get_s3_client()
+    raw_bucket = os.getenv("S3_RAW_BUCKET")
+    concurrency = _worker_concurrency()
+    batch_size = min(int(os.getenv("WORKER_BATCH_SIZE", "10")), 10) # SQS max is 10
+    scheduler = JobScheduler(concurrency)
+    in_flight = {} # future -> Job
+
+    def on_job_done(future):
+        message = in_flight.pop(future).message
+        error = future.exception()
+        if isinstance(error, BrokenProcessPool):
+            # Job process died (eg OOM), leave message on queue to be redelivered
+            print(f"Job process crashed, message {message['MessageId']} left for redelivery")
+            return
+        if error is not None:
+            # The job could not claim its file (eg DB down), the file is still PENDING: redeliver the message
+            print(f"Job failed before claiming its file, message {message['MessageId']} left for redelivery: {error}")
+            return
+        queue.delete(message)
 
-    print("Worker started, polling for messages...")
+    print(f"Worker started with {concurrency} job slots ({scheduler.reserved_small_slots} reserved for small jobs), polling for messages...")
+    start_metrics_server()
+    # extends visibility of held messages, renews running jobs' leases, and requeues files whose worker died
+    LeaseKeeper(queue, lambda: [
+        *((job.message, job.file_id, True) for job in list(in_flight.values())),
+        *((job.message, job.file_id, False) for job in list(scheduler.buffer)),
+    ]).start()
+    pool = ProcessPoolExecutor(max_workers=concurrency, initializer=_init_job_process)
     while True:
-        response = sqs_client.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=1, WaitTimeSeconds=10)
-        if "Messages" in response:
-            message = response["Messages"][0]
+        running = {f: job for f, job in list(in_flight.items()) if not f.done()}
+        running_large = sum(job.large for job in running.values())
+        free_slots = concurrency - len(running)
+
+        # Start buffered jobs while slots are free
+        while free_slots > 0:
+            job = scheduler.pop(running_large)
+            if job is None:
+                break
+            threads = encoder_threads(job.cost, [running_job.cost for running_job in running.values()])
+            try:
+                future = pool.submit(process_single_message, job.message, job.metadata, WORKER_ID, threads)
+            except BrokenProcessPool:
+                # Pool is unusable after a job process crash, start a fresh one
+                print("Job pool broken, restarting")
+                pool = ProcessPoolExecutor(max_workers=concurrency, initializer=_init_job_process)
+                future = pool.submit(process_single_message, job.message, job.metadata, WORKER_ID, threads)
+            in_flight[future] = job
+            future.add_done_callback(on_job_done)
+            running[future] = job
+            running_large += job.large
+            free_slots -= 1
+
+        # slots still free here are ones no buffered job may take
+        room = min(batch_size, scheduler.free_buffer(free_slots))
+        if room == 0:
+            wait(running, timeout=5, return_when=FIRST_COMPLETED)
+            continue
+        # Long poll while a slot is free. With every slot busy only top up the buffer, then wait for a job to finish
+        messages = []
+        for message in queue.receive(room, 10 if free_slots > 0 else 0):
             body = json.loads(message['Body'])
             print(body)
             # Ignore s3:TestEvent
             if body.get("Event") == "s3:TestEvent":
-                sqs_client.delete_message(QueueUrl=queue_url, ReceiptHandle=message["ReceiptHandle"])
+                queue.delete(message)
                 continue
-            process_single_message(message)
-            sqs_client.delete_message(QueueUrl=queue_url, ReceiptHandle=message["ReceiptHandle"])
+            messages.append(message)
+        scheduler.add(messages, s3_client, raw_bucket)
+        if free_slots <= 0 and running:
+            wait(running, timeout=5, return_when=FIRST_COMPLETED)
 
 
-def process_single_message(message: dict):
+def process_single_message(message: dict, metadata: dict = None, worker_id: str = None, threads: int = None):
     db = SessionLocal()
-    s3_endpoint_url = os.getenv("S3_ENDPOINT_URL") or None
-    s3_client = boto3.client("s3", endpoint_url=s3_endpoint_url)
+    s3_client = get_s3_client()
     raw_bucket = os.getenv("S3_RAW_BUCKET")
     processed_bucket = os.getenv("S3_PROCESSED_BUCKET")
     file_id = None
+    claimed = False
+    timings = {} # stage -> seconds, see timing.STAGES
 
     try: 
         body = json.loads(message['Body'])
         s3_key = body['Records'][0]['s3']['object']['key'] # s3key is original_filename-uuid
-        key_without_ext, _ = os.path.splitext(s3_key)
-        uuid_str = key_without_ext[-36:]
-        file_id = UUID(uuid_str) 
+        file_id = file_id_from_key(s3_key)
 
-        ## Idempotency check - Get File Status, discard message if File status = PROCESSING
-        ## to avoid case where message queue triggers transcoding multiple times when file is already processing (but not yet completed)
-        db_file = crud.get_file(db, file_id)
+        ## Idempotency check - atomically claim the file: PENDING -> PROCESSING in one conditional update
+        ## so duplicate messages and concurrent workers can never transcode the same file twice.
+        ## A file left PROCESSING by a dead worker is claimable again once its lease expires
+        db_file = crud.claim_file(db, file_id, worker_id, lease_seconds())
         if not db_file:
-            print(f"File ID {file_id} not found in database. Discarding message.")
+            print(f"Skipping message for file_id: {file_id}. File not found, not pending or leased by another worker.")
             return # Exit the function, the message will be deleted
-        current_status = db_file.processing_status
-        if current_status == models.ProcessingStatus.PENDING: # New transcoding job
-            transcode_file(db, file_id, s3_key, s3_client, raw_bucket, processed_bucket)
-        else: # is already being processed or complete, ignore
-            print(f"Skipping duplicate message for file_id: {file_id}. Current status: {current_status}")
+        claimed = True
+        if "eventTime" in body['Records'][0]:
+            record(timings, "queue_wait", seconds_since(body['Records'][0]["eventTime"]))
+
+        # Content-hash cache: an identical upload may have completed since this one was queued.
+        # Renditions are per file, a job requesting them is always encoded
+        source = not db_file.rendition_set and db_file.content_hash and crud.get_completed_file_by_hash(
+            db, db_file.content_hash, exclude_file_id=file_id, target_codec=db_file.target_codec, faststart=db_file.faststart
+        )
+        if source and crud.reuse_processed_output(db, file_id, source, worker_id=worker_id):
+            print(f"Cache hit for {file_id}: reused processed output of {source.file_id}")
+        else:
+            transcode_file(
+                db, file_id, s3_key, s3_client, raw_bucket, processed_bucket, metadata, timings,
+                db_file.rendition_set, db_file.target_codec, bool(db_file.faststart), worker_id, threads,
+            )
     except Exception as e:
-        # If file_id was extracted, we can log failure against it
+        # If this worker claimed the file, we can log failure against it
         # Any failure from codec format, S3 download, ffmpeg transcoding, s3 upload
-        if file_id:
-            handle_processing_failure(db, file_id, e)
+        if claimed:
+            handle_processing_failure(db, file_id, e, worker_id)
+        elif file_id:
+            # Not claimed, so nothing recorded a failure and the lease reaper will not requeue the file.
+            # Raise so the message is not deleted and is redelivered after its visibility timeout
+            print(f"Failed to claim file_id {file_id}: {e}")
+            raise
         else:
             print(f"Failed to parse message or extract file_id: {message['Body']}")
     finally:
         db.close()
 
-def get_video_codec(file_path: str) -> str: # returns `h264` or `hevc` (for h265)
-    command = [
-        "ffprobe", "-v", "error", "-select_streams", "v:0",
-        "-show_entries", "stream=codec_name", "-of", "compact=p=0:nk=1",
-        "-i", file_path,
-    ]
+def transcode_file(db: Session, file_id: UUID, s3_key: str, s3_client, raw_bucket: str, processed_bucket: str, metadata: dict = None, timings: dict = None,
+                   rendition_set: list = None, requested_codec: Codec = None, faststart: bool = False, worker_id: str = None,
+                   threads: int = None):
+    timings = {} if timings is None else timings
+    print(f"Transcoding file: {s3_key}")
+    start_time = time.time()
+    print("start time", start_time)
+
+    # Probe with range reads before any download, unsupported files fail here.
+    # Usually already probed by the scheduler when the message was received
+    if metadata is None:
+        try:
+            with timed(timings, "probe"):
+                metadata = probe_s3_object(s3_client, raw_bucket, s3_key)
+        except ClientError as e:
+            error_code = e.response.get("Error", {}).get("Code")
+            raise RuntimeError(f"S3 Probe Failed (Error: {error_code})") from e
+    elif metadata.get("probe_seconds") is not None:
+        record(timings, "probe", metadata["probe_seconds"])
+
+    original_codec = metadata["original_codec"]
+    if requested_codec is not None:
+        target_codec = requested_codec
+    elif original_codec == Codec.H264:
+        target_codec = Codec.HEVC
+    elif original_codec == Codec.HEVC:
+        target_codec = Codec.H264
+    else:
+        raise RuntimeError(f"Unsupported codec '{original_codec}' for transcoding.")
+
+    # Faster presets when the backlog is deep, slower higher quality ones when the queue is idle
+    queue_depth = _queue_depth()
+    profile = select_profile(target_codec, metadata["duration"], queue_depth, threads=threads)
+    # Source already in the target codec: only the container changes, stream copy instead of re-encoding
+    remux_only = target_codec == original_codec
+    if remux_only:
+        print(f"{file_id} is already {target_codec.value}, remuxing")
+        metadata["encoding_profile"] = "stream copy"
+    else:
+        print(f"Encoding profile for {file_id} with {queue_depth} queued jobs: {profile.name}")
+        metadata["encoding_profile"] = profile.name
+    crud.update_file_metadata(db, file_id, metadata)
+    renditions = _rendition_outputs(rendition_set, metadata, s3_key, processed_bucket, profile, queue_depth, faststart)
+
+    progress = ProgressTracker(db, file_id, metadata["duration"])
+    # Poster and sprite from keyframe seeks on the raw object, alongside the transcode
+    previews_executor = ThreadPoolExecutor(max_workers=1)
+    previews = previews_executor.submit(build_previews, s3_client, raw_bucket, processed_bucket, s3_key, metadata["duration"])
+    previews_executor.shutdown(wait=False)
     try:
-        print(f"Running ffprobe command: {' '.join(command)}")
-        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=True)
-        codec_str = result.stdout.strip()
-        print("codec", codec_str)
-        return Codec(codec_str)
-    except ValueError:
-        raise RuntimeError(f"Unsupported codec detected: {codec_str}")
-    except subprocess.CalledProcessError as e:
-        raise RuntimeError(f"ffprobe get codec failed: {e.stderr}")
-    
-def ffmpeg_popen(command):
-    print("ffmpeg_popen")
-    # execute with Popen, stream output from ffmpeg progress from the stderr stream
+        rendition_rows = []
+        if renditions or remux_only or faststart:
+            # Renditions split one decode from the local input. Remuxes and faststart outputs
+            # need a seekable output file to move the moov atom to the front
+            content_hash, rendition_rows = transcode_file_staged(
+                s3_key, s3_client, raw_bucket, processed_bucket, target_codec, metadata, progress, profile, timings,
+                renditions, remux_only, faststart,
+            )
+        elif streaming_enabled() and metadata["faststart"]:
+            with timed(timings, "encode"): # download, encode and upload overlap
+                content_hash = transcode_file_streaming(s3_key, s3_client, raw_bucket, processed_bucket, target_codec, metadata, progress, profile)
+        else:
+            if streaming_enabled():
+                print(f"moov atom not before mdat in {s3_key}, falling back to staged transcode")
+            content_hash, _ = transcode_file_staged(s3_key, s3_client, raw_bucket, processed_bucket, target_codec, metadata, progress, profile, timings)
+
+        if metadata["duration"] and timings.get("encode") and not remux_only:
+            ENCODE_REALTIME_FACTOR.labels(target_codec.value).observe(metadata["duration"] / timings["encode"])
+
+        # Finalize: measured up to the completion statement, which stores it with the other stage timings in one write
+        print("finalizing")
+        with timed(timings, "finalize"):
+            preview_urls = previews.result() # usually done long before the encode
+            processing_time = time.time() - start_time
+            processed_url = f"s3://{processed_bucket}/{s3_key}"
+        completed = crud.finalize_file_on_completion(
+            db, file_id, processed_url, processing_time, original_codec, target_codec, content_hash, timings, rendition_rows, worker_id,
+            preview_urls, metadata["duration"],
+        )
+    except Exception:
+        # Previews are only kept with a finalized job: stop them, or wait for their uploads, and remove what they wrote
+        _discard_previews(previews, s3_client, processed_bucket, s3_key)
+        raise
+    if not completed:
+        print(f"Lease on {file_id} was lost to another worker, its result is kept instead")
+        return
+    print(f"Successfully processed {file_id}")
+
+def _discard_previews(previews, s3_client, processed_bucket: str, s3_key: str):
+    if previews.cancel():
+        return
+    delete_previews(s3_client, processed_bucket, s3_key, previews.result())
+
+# Output specs for the requested renditions below the source resolution, renditions are never upscaled
+def _rendition_outputs(rendition_set: list, metadata: dict, s3_key: str, processed_bucket: str, profile: EncodingProfile, queue_depth: int, faststart: bool) -> list:
+    outputs = []
+    profiles = {}
+    for name in rendition_set or ():
+        spec = rendition_spec(name)
+        if metadata["height"] and spec["height"] >= metadata["height"]:
+            print(f"Skipping rendition {name}, source is only {metadata['height']}p")
+            continue
+        if spec["codec"] not in profiles:
+            profiles[spec["codec"]] = select_profile(spec["codec"], metadata["duration"], queue_depth).with_threads(profile.threads)
+        key = rendition_key(s3_key, name)
+        outputs.append({
+            **spec,
+            "width": round(metadata["width"] * spec["height"] / metadata["height"] / 2) * 2 if metadata["width"] and metadata["height"] else None,
+            "profile": profiles[spec["codec"]],
+            "faststart": faststart,
+            "path": f"/tmp/{os.path.basename(key)}",
+            "key": key,
+            "file_url": f"s3://{processed_bucket}/{key}",
+        })
+    return outputs
+
+# Streams S3 -> ffmpeg -> S3 without local files. Returns the content hash
+def transcode_file_streaming(s3_key: str, s3_client, raw_bucket: str, processed_bucket: str, target_codec: Codec, metadata: dict, progress: ProgressTracker, profile: EncodingProfile) -> str:
     try:
-        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                                text=True, bufsize=1, universal_newlines=True)
-        for line in process.stdout:
-            print(f"[ffmpeg] {line.strip()}")
-        # Wait for the process to complete and check its return code
-        process.wait()
-        if process.returncode != 0:
-            # If ffmpeg failed, raise an error
-            raise RuntimeError(f"FFmpeg transcode to h265 failed with exit code {process.returncode}")
-    except subprocess.CalledProcessError as e:
-        raise RuntimeError(f"FFmpeg process failed: {e.stderr}")
-
-def transcode_to_h264(input_path: str, output_path: str):
-    print(f"Transcoding from HEVC to H.264")
-    command = [
-        "ffmpeg", "-i", input_path, "-c:v", "libx264", # libx264 encoder
-        "-preset", "fast", "-crf", "23", "-c:a", "copy", output_path
-    ]
-    ffmpeg_popen(command)
-    
-def transcode_to_h265(input_path: str, output_path: str):
-    print(f"Transcoding from H.264 to HEVC")
-    command = [
-        "ffmpeg", "-i", input_path, "-c:v", "libx265", # libx265 encoder
-        "-preset", "fast", "-crf", "28", "-vtag", "hvc1", "-c:a", "copy", output_path
-    ]
-    ffmpeg_popen(command)
-    
-
-def transcode_file(db: Session, file_id: UUID, s3_key: str, s3_client, raw_bucket: str, processed_bucket: str):
-    print(f"Transcoding file: {s3_key}")
+        return transcode_streaming(s3_client, raw_bucket, processed_bucket, s3_key, target_codec, metadata["file_size"], progress.callback(), profile)
+    except ClientError as e:
+        error_code = e.response.get("Error", {}).get("Code")
+        raise RuntimeError(f"S3 Streaming Failed (Error: {error_code})") from e
+
+# Downloads to /tmp, transcodes locally, uploads the result and any renditions.
+# Returns the content hash and the Renditions rows to record
+def transcode_file_staged(s3_key: str, s3_client, raw_bucket: str, processed_bucket: str, target_codec: Codec, metadata: dict, progress: ProgressTracker, profile: EncodingProfile, timings: dict,
+                          renditions: list = (), remux_only: bool = False, faststart: bool = False):
     filename = os.path.basename(s3_key)
     input_path = f"/tmp/{filename}"
     output_path = f"/tmp/processed-{filename}"
+    main_output = {"path": output_path, "key": s3_key, "codec": target_codec, "profile": profile, "faststart": faststart}
+    outputs = [main_output, *renditions]
 
     try:
-        # Start transaction
-        print("DB updating file status and transactions to processing")
-        crud.update_file_status(db, file_id, models.ProcessingStatus.PROCESSING)
-        crud.create_transaction(db, file_id, models.TransactionType.PROCESSING, details="Started processing")
-        start_time = time.time()
-        print("start time", start_time)
-
         # Download, process, upload
         try:
             print(f"Downloading s3://{raw_bucket}/{s3_key} to {input_path}")
-            s3_client.download_file(raw_bucket, s3_key, input_path)
+            with timed(timings, "download"):
+                s3_client.download_file(raw_bucket, s3_key, input_path)
+            observe_transfer("download", metadata["file_size"], timings["download"])
         except ClientError as e:
             error_code = e.response.get("Error", {}).get("Code")
             raise RuntimeError(f"S3 Download Failed (Error: {error_code})") from e
-        
-        original_codec = get_video_codec(input_path)
-
-        if original_codec == Codec.H264:
-            target_codec = Codec.HEVC
-            transcode_to_h265(input_path, output_path)
-        elif original_codec == Codec.HEVC:
-            target_codec = Codec.H264
-            transcode_to_h264(input_path, output_path)
-        else:
-            raise RuntimeError(f"Unsupported codec '{original_codec}' for transcoding.")
-        
+
+        with open(input_path, "rb") as f:
+            content_hash = hashlib.file_digest(f, "sha256").hexdigest()
+
+        with timed(timings, "encode"):
+            if remux_only: # container fix only, renditions (if any) still need an encode
+                remux(input_path, output_path)
+                if renditions:
+                    transcode_outputs(input_path, renditions, progress.callback())
+            elif renditions: # decode once, split to every output's encoder
+                transcode_outputs(input_path, outputs, progress.callback())
+            elif should_segment(metadata["file_size"], metadata["duration"]): # long input, encode keyframe-aligned segments in parallel
+                transcode_segmented(input_path, output_path, target_codec, progress, profile, faststart)
+            elif target_codec == Codec.HEVC:
+                transcode_to_h265(input_path, output_path, progress.callback(), profile, faststart)
+            else:
+                transcode_to_h264(input_path, output_path, progress.callback(), profile, faststart)
+
+        def upload_output(output: dict):
+            print(f"Uploading transcoded file {output['path']} to s3://{processed_bucket}/{output['key']}")
+            s3_client.upload_file(output["path"], processed_bucket, output["key"])
+
         try:
-            print(f"Uploading transcoded file {output_path} to s3://{processed_bucket}/{s3_key}")
-            s3_client.upload_file(output_path, processed_bucket, s3_key)
+            # all outputs upload concurrently, each upload_file is itself multipart
+            with timed(timings, "upload"):
+                with ThreadPoolExecutor(max_workers=len(outputs)) as executor:
+                    list(executor.map(upload_output, outputs))
+            observe_transfer("upload", sum(os.path.getsize(output["path"]) for output in outputs), timings["upload"])
         except ClientError as e:
             # If the bucket doesn't exist or we don't have permission, catch it here.
             error_code = e.response.get("Error", {}).get("Code")
             raise RuntimeError(f"S3 Upload Failed (Error: {error_code})") from e
 
-        # Finalize
-        print("finalizing")
-        processing_time = time.time() - start_time
-        processed_url = f"s3://{processed_bucket}/{s3_key}"
-        crud.finalize_file_on_completion(db, file_id, processed_url, processing_time, original_codec, target_codec)
-        crud.create_transaction(db, file_id, models.TransactionType.COMPLETION, f"Completed in {processing_time:.2f}s")
-        print(f"Successfully processed {file_id}")
+        rendition_rows = [
+            {
+                "name": output["name"], "codec": output["codec"], "width": output["width"], "height": output["height"],
+                "file_url": output["file_url"], "file_size": os.path.getsize(output["path"]),
+            }
+            for output in renditions
+        ]
+        return content_hash, rendition_rows
 
     finally:
         # Cleanup local temp files
         if os.path.exists(input_path): os.remove(input_path)
-        if os.path.exists(output_path): os.remove(output_path)
+        for output in outputs:
+            if os.path.exists(output["path"]): os.remove(output["path"])
 
 
-def handle_processing_failure(db: Session, file_id: UUID, error: Exception):
+def handle_processing_failure(db: Session, file_id: UUID, error: Exception, worker_id: str = None):
     error_details = f"Processing failed: {str(error)}"
     print(error_details)
-    crud.update_file_status(db, file_id, models.ProcessingStatus.FAILED)
-    crud.create_transaction(db, file_id, models.TransactionType.FAILURE, details=f"Upload failed: {str(error_details)}")
+    db.rollback() # discard a transaction left open by the failure
+    crud.fail_file(db, file_id, details=error_details, worker_id=worker_id)
 
 if __name__ == "__main__":
     process_messages()
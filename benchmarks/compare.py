@@ -0,0 +1,52 @@
+"""
+Compares two run_benchmark.py result files, eg a baseline from main and a run from a branch.
+Exits with status 1 if throughput drops or any stage's p95 grows by more than --threshold percent.
+
+python benchmarks/compare.py baseline.json results.json --threshold 10
+"""
+
+import argparse
+import json
+import sys
+
+def _change(before, after):
+    if not before or after is None:
+        return None
+    return (after - before) / before * 100
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two benchmark result files")
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--threshold", type=float, default=10, help="percent regression that fails the comparison")
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+
+    regressions = []
+    throughput_change = _change(baseline["throughput_files_per_second"], candidate["throughput_files_per_second"])
+    print(f"throughput: {baseline['throughput_files_per_second']:.3f} -> {candidate['throughput_files_per_second']:.3f} files/s ({throughput_change or 0:+.1f}%)")
+    if throughput_change is not None and -throughput_change > args.threshold:
+        regressions.append("throughput")
+
+    print(f"{'stage':<14}{'p50 before':>12}{'p50 after':>12}{'change':>9}{'p95 before':>12}{'p95 after':>12}{'change':>9}")
+    for stage, before in baseline["stages"].items():
+        after = candidate["stages"].get(stage, {})
+        if not before.get("count") or not after.get("count"):
+            continue
+        p50_change = _change(before["p50"], after["p50"])
+        p95_change = _change(before["p95"], after["p95"])
+        print(f"{stage:<14}{before['p50']:>12.3f}{after['p50']:>12.3f}{p50_change or 0:>+8.1f}%"
+              f"{before['p95']:>12.3f}{after['p95']:>12.3f}{p95_change or 0:>+8.1f}%")
+        if p95_change is not None and p95_change > args.threshold:
+            regressions.append(stage)
+
+    if regressions:
+        print(f"Regressed by more than {args.threshold}%: {', '.join(regressions)}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
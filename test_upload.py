@@ -23,8 +23,8 @@ TEST_FILES = {
     f"{TESTS_FILES_FOLDER}/bunny_264_2s.mp4": {"original": "h264", "processed": "hevc"},
 }
 
-def test_upload_file(filepath: str) -> str:
-    """Tests Uploads file with a file object and returns file_id"""
+def test_upload_file(filepath: str) -> tuple:
+    """Tests Uploads file with a file object and returns file_id and processing_status"""
     
     print(f"\n--- Step 1: Uploading '{os.path.basename(file_path)}' to API ---")
 
@@ -34,7 +34,7 @@ def test_upload_file(filepath: str) -> str:
     file_id = response.json()['file_id']
     if file_id:
             print(f"✅ Upload successful for {os.path.basename(file_path)}, File ID: {file_id}")
-    return file_id
+    return file_id, response.json()['processing_status']
 
 def test_unhappy_path_download(file_id: str):
     """Tests that downloading a file before it's ready returns a 404 error."""
@@ -55,13 +55,18 @@ def test_poll_for_completion(file_id: str) -> dict:
     """Polls the status endpoint, expects pending until processing is complete or failed."""
     
     print("\n--- Step 3: Polling for processing status ---")
-    status_endpoint = f"{UPLOAD_ENDPOINT}/{file_id}/status"
+    # long-poll: each request returns as soon as the status changes from `current_status`
+    wait_endpoint = f"{UPLOAD_ENDPOINT}/{file_id}/status/wait"
 
     timeout = 300 # 5min. above smaller test files should take about 30s - 1m depending on local specs
     start_time = time.time()
+    status = None
 
     while True:
-        response = requests.get(status_endpoint)
+        params = {"timeout": 30}
+        if status:
+            params["current_status"] = status
+        response = requests.get(wait_endpoint, params=params)
         response.raise_for_status()
         status_json = response.json()
         status = status_json.get("processing_status")
@@ -71,7 +76,6 @@ def test_poll_for_completion(file_id: str) -> dict:
         if time.time() - start_time > timeout:
             print("timeout")
             break
-        time.sleep(5)
 
     if status != "completed":
         raise RuntimeError(f"Transcoding failed with final status: '{status}'")
@@ -150,10 +154,14 @@ def run_e2e_test_for_file(file_path: str, expected_codecs: dict):
     
     try:
         # Step 1: Upload
-        file_id = test_upload_file(file_path)
+        file_id, status = test_upload_file(file_path)
         
         # Step 2: Unhappy Path Test:
-        test_unhappy_path_download(file_id)
+        # an identical file uploaded by an earlier run is reused, and the upload is completed straight away
+        if status == "completed":
+            print("\n--- Step 2: Skipped, upload reused the processed output of an earlier identical upload ---")
+        else:
+            test_unhappy_path_download(file_id)
         
         # Step 3: Poll for completion
         test_poll_for_completion(file_id)